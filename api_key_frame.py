@@ -2,7 +2,24 @@
 Class for handling the input of the REDCap API key/url and connecting to REDCap
 """
 import wx
-import redcap
+
+from worker import Worker, EVT_WORKER_DONE, EVT_WORKER_PROGRESS
+
+
+def connect_project(worker, redcap_url, api_keys, cache):
+    """
+    Connect to one or more REDCap projects and load their metadata. Runs on a Worker thread.
+    :param worker: Worker running the task
+    :param redcap_url: REDCap API URL
+    :param api_keys: REDCap API keys of the projects
+    :param cache: RecordCache to keep the metadata in, or None
+    :return: list of (RedcapClient, ProjectMetadata), in the order of api_keys
+    """
+    worker.progress('Connecting...')
+    # Imported here rather than at the top so this module, and the API key window, load without the REDCap client.
+    # The report modules are imported on a background thread as this window opens, so it is usually loaded by now.
+    import multi_project
+    return multi_project.connect_all(redcap_url, api_keys, cache)
 
 
 class APIKeyFrame(wx.Frame):
@@ -15,24 +32,35 @@ class APIKeyFrame(wx.Frame):
         self.panel = wx.Panel(self)
         self.sizer = wx.BoxSizer(wx.VERTICAL)
 
-        text = wx.StaticText(self.panel, label='Paste your api key and REDCap url below:')
-        self.api_key_text = wx.TextCtrl(self.panel, value='', size=wx.Size(300, 10))
+        text = wx.StaticText(self.panel, label='Paste your api key and REDCap url below.\n'
+                                               'Paste one key per line to report on several projects together:')
+        self.api_key_text = wx.TextCtrl(self.panel, value='', size=wx.Size(300, 60), style=wx.TE_MULTILINE)
         self.redcap_url_text = wx.TextCtrl(self.panel, value="https://redcap.ahc.umn.edu/api/")
+        participant_label = wx.StaticText(self.panel, label='Participant ID field, to count participants in several '
+                                                            'projects once (optional):')
+        self.participant_field_text = wx.TextCtrl(self.panel, value='')
 
         self.error_str = wx.StaticText(self.panel, label='')
         self.error_str.Hide()
         self.error_str.SetForegroundColour(wx.RED)
 
-        connect_btn = wx.Button(self.panel, label='Connect')
-        connect_btn.Bind(wx.EVT_BUTTON, self.connect)
-        connect_btn.SetDefault()
+        self.status_str = wx.StaticText(self.panel, label='')
+
+        self.connect_btn = wx.Button(self.panel, label='Connect')
+        self.connect_btn.Bind(wx.EVT_BUTTON, self.connect)
+        self.connect_btn.SetDefault()
         self.Bind(wx.EVT_CLOSE, self.on_close)
+        self.Bind(EVT_WORKER_PROGRESS, self.on_progress)
+        self.Bind(EVT_WORKER_DONE, self.on_connected)
 
         self.sizer.Add(text, 1, wx.ALL | wx.ALIGN_LEFT, 5)
         self.sizer.Add(self.api_key_text, 1, wx.ALL | wx.EXPAND, 5)
         self.sizer.Add(self.redcap_url_text, 1, wx.ALL | wx.EXPAND, 5)
+        self.sizer.Add(participant_label, 1, wx.ALL | wx.ALIGN_LEFT, 5)
+        self.sizer.Add(self.participant_field_text, 1, wx.ALL | wx.EXPAND, 5)
         self.sizer.Add(self.error_str, 1, wx.ALL | wx.ALIGN_LEFT, 5)
-        self.sizer.Add(connect_btn, 1, wx.ALL | wx.ALIGN_RIGHT, 5)
+        self.sizer.Add(self.status_str, 1, wx.ALL | wx.ALIGN_LEFT, 5)
+        self.sizer.Add(self.connect_btn, 1, wx.ALL | wx.ALIGN_RIGHT, 5)
 
         self.panel.SetSizer(self.sizer)
         self.sizer.Fit(self)
@@ -48,35 +76,62 @@ class APIKeyFrame(wx.Frame):
 
     def connect(self, evt):
         """
-        Establishes a connection with the REDCap API and stores a reference to the project
-        object in the parent window.
+        Starts connecting to the REDCap API on a background worker.
         :param evt: Event which triggered the connection
         """
-        api_key = self.api_key_text.GetValue()
+        api_keys = [key.strip() for key in self.api_key_text.GetValue().splitlines() if key.strip()]
         redcap_url = self.redcap_url_text.GetValue()
-        try:
-            self.parent.project = redcap.Project(redcap_url, api_key)
-            self.parent.report_window.fill_options()
-            self.parent.report_window.Enable()
-            self.parent.sizer.Fit(self.parent)
-            w, h = self.parent.report_window.GetSize()
-            max = wx.Display().GetClientArea()
-            self.parent.SetSize(min(w + 100, max.Width), min(h + 100, max.Height))
-
-            # Enable scrolling after content is filled
-            # w, h = self.parent.report_window.sizer.GetMinSize()
-            # self.parent.report_window.SetVirtualSize((w, h))
-            fontsz = wx.SystemSettings.GetFont(wx.SYS_SYSTEM_FONT).GetPixelSize()
-            self.parent.report_window.SetScrollRate(fontsz.x, fontsz.y)
-            self.parent.report_window.EnableScrolling(True, True)
-
-            # Fire a size event to fix disappearing widgets on scroll
-            wx.PostEvent(self.parent.GetEventHandler(), wx.PyCommandEvent(wx.EVT_SIZE.typeId, self.parent.GetId()))
-
-            self.parent.Show()
-            self.Destroy()
-
-        except redcap.RedcapError as e:
-            self.error_str.SetLabelText(str(e))
+        self.error_str.Hide()
+        self.connect_btn.Disable()
+        Worker(self, connect_project, redcap_url, api_keys, self.parent.cache).start()
+
+    def on_progress(self, evt):
+        """
+        Shows the current step of connecting
+        :param evt: WorkerProgressEvent of the connection
+        """
+        self.status_str.SetLabelText(evt.message)
+
+    def on_connected(self, evt):
+        """
+        Shows the connected projects in the parent window once it has its report window, or shows the error if
+        connecting failed.
+        :param evt: WorkerDoneEvent of the connection
+        """
+        self.status_str.SetLabelText('')
+        if evt.error:
+            self.connect_btn.Enable()
+            self.error_str.SetLabelText(str(evt.error))
             self.error_str.Show()
             self.sizer.Fit(self)
+            return
+        self.parent.when_report_window_ready(lambda: self.show_report(evt.result))
+
+    def show_report(self, sources):
+        """
+        Stores references to the connected projects in the parent window and shows it
+        :param sources: list of (RedcapClient, ProjectMetadata) of the connected projects
+        """
+        import multi_project  # Already loaded with the report window
+        self.parent.sources = sources
+        self.parent.use_participant_field(self.participant_field_text.GetValue().strip() or None)
+        self.parent.report_window.fill_options(multi_project.combined_choices(self.parent.sources, 'grant'),
+                                               multi_project.combined_choices(self.parent.sources, 'protocol'))
+        self.parent.report_window.Enable()
+        self.parent.sizer.Fit(self.parent)
+        w, h = self.parent.report_window.GetSize()
+        max = wx.Display().GetClientArea()
+        self.parent.SetSize(min(w + 100, max.Width), min(h + 100, max.Height))
+
+        # Enable scrolling after content is filled
+        # w, h = self.parent.report_window.sizer.GetMinSize()
+        # self.parent.report_window.SetVirtualSize((w, h))
+        fontsz = wx.SystemSettings.GetFont(wx.SYS_SYSTEM_FONT).GetPixelSize()
+        self.parent.report_window.SetScrollRate(fontsz.x, fontsz.y)
+        self.parent.report_window.EnableScrolling(True, True)
+
+        # Fire a size event to fix disappearing widgets on scroll
+        wx.PostEvent(self.parent.GetEventHandler(), wx.PyCommandEvent(wx.EVT_SIZE.typeId, self.parent.GetId()))
+
+        self.parent.Show()
+        self.Destroy()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Batch reports: many grant/protocol/date range reports computed from a single export of the project.
+
+Run with `python -m batch_report --help`. Report specs are read from a JSON file holding a list of objects such as
+{"name": "Grant A 2020 Q1", "grants": ["Grant A"], "protocols": ["Protocol 1"], "start": "2020-01-01",
+"end": "2020-03-31"}. Leaving out "grants" or "protocols" includes all of them.
+"""
+import argparse
+import collections
+import csv
+import datetime
+import json
+import os
+import re
+import sys
+
+import numpy as np
+import redcap
+
+from enrollment_index import parse_date
+from project_metadata import connect
+from record_cache import DEFAULT_PATH, REPORT_FIELDS, RecordCache
+from redcap_client import TIMEOUT
+from report_cli import DEFAULT_URL
+from report_pipeline import build_filter_logic, record_payload, stream_records, write_report
+from tabulation import CELLS, ETHNICITIES, GENDERS, LABEL_LOOKUPS, RACES, CountTable, cell_codes
+
+ReportSpec = collections.namedtuple('ReportSpec', ['name', 'grants', 'protocols', 'start', 'end'])
+
+
+def load_specs(file, grant_choices, protocol_choices):
+    """
+    Read report specs from a JSON file
+    :param file: file to read from
+    :param grant_choices: dict of grant choice code to label, for specs which include all grants
+    :param protocol_choices: dict of protocol choice code to label, for specs which include all protocols
+    :return: list of ReportSpec
+    :raises ValueError: if a spec is missing a field or names an unknown grant or protocol
+    """
+    specs = []
+    for i, spec in enumerate(json.load(file)):
+        try:
+            spec = ReportSpec(spec.get('name', 'report_{}'.format(i + 1)),
+                              spec.get('grants') or list(grant_choices.values()),
+                              spec.get('protocols') or list(protocol_choices.values()),
+                              datetime.date.fromisoformat(spec['start']), datetime.date.fromisoformat(spec['end']))
+        except KeyError as e:
+            raise ValueError('Report {} has no {}'.format(i + 1, e))
+        for label in spec.grants:
+            if label not in grant_choices.values():
+                raise ValueError('{}: {} is not a grant'.format(spec.name, label))
+        for label in spec.protocols:
+            if label not in protocol_choices.values():
+                raise ValueError('{}: {} is not a protocol'.format(spec.name, label))
+        if spec.start > spec.end:
+            raise ValueError('{}: start date must be earlier than end date'.format(spec.name))
+        specs.append(spec)
+    return specs
+
+
+def compute_batch(records, specs, metadata=None):
+    """
+    Count the participants of every report with one shared group-by over grant, protocol and enrollment period.
+
+    The enrollment dates are split into periods at every report's start date and the day after its end date.
+    Records are counted once into a cube indexed by (grant, protocol, period, demographic cell), and each report
+    is then the sum of the slices of the cube covering its grants, protocols and periods.
+
+    :param records: records with enrollment, grant, protocol and demographic fields
+    :param specs: list of ReportSpec
+    :param metadata: ProjectMetadata if the records hold raw codes, None if they hold labels
+    :return: list of CountTable, one per spec
+    """
+    lookups = metadata.demographic_lookups() if metadata else LABEL_LOOKUPS
+
+    grant_codes = {}
+    protocol_codes = {}
+    keys = []
+    dates = []
+    participants = []
+    for r in records:
+        if r.get('grant') and r.get('protocol') and r.get('enrollment'):
+            enrollment = parse_date(r['enrollment'])
+            if enrollment:
+                keys.append((grant_codes.setdefault(r['grant'], len(grant_codes)),
+                             protocol_codes.setdefault(r['protocol'], len(protocol_codes))))
+                dates.append(enrollment.toordinal())
+                participants.append(r)
+
+    boundaries = np.unique([s.start.toordinal() for s in specs] + [s.end.toordinal() + 1 for s in specs])
+    # Period i holds the enrollments from boundaries[i] up to the day before boundaries[i + 1], with an extra
+    # period 0 before the first boundary
+    periods = np.searchsorted(boundaries, np.asarray(dates, dtype=np.int64), side='right')
+    keys = np.asarray(keys, dtype=np.int64).reshape((-1, 2))
+    n_grants, n_protocols, n_periods = len(grant_codes), len(protocol_codes), len(boundaries) + 1
+
+    # Slot 0 of the last axis counts participants whose demographics match no category, so totals stay right
+    cells = cell_codes(participants, lookups) + 1
+    groups = ((keys[:, 0] * n_protocols + keys[:, 1]) * n_periods + periods) * (CELLS + 1) + cells
+    cube = np.bincount(groups, minlength=n_grants * n_protocols * n_periods * (CELLS + 1)).reshape(
+        (n_grants, n_protocols, n_periods, CELLS + 1))
+
+    tables = []
+    for spec in specs:
+        grants, protocols = set(spec.grants), set(spec.protocols)
+        if metadata:
+            grants = {metadata.code('grant', g) for g in grants}
+            protocols = {metadata.code('protocol', p) for p in protocols}
+        grants = [grant_codes[g] for g in grants if g in grant_codes]
+        protocols = [protocol_codes[p] for p in protocols if p in protocol_codes]
+        first = int(np.searchsorted(boundaries, spec.start.toordinal())) + 1
+        last = int(np.searchsorted(boundaries, spec.end.toordinal() + 1)) + 1
+        counts = cube[np.ix_(grants, protocols)][:, :, first:last].sum(axis=(0, 1, 2))
+        tables.append(CountTable(counts[1:].reshape((len(RACES), len(ETHNICITIES), len(GENDERS))),
+                                 total=int(counts.sum())))
+    return tables
+
+
+def export_batch_records(project, specs, grant_choices, protocol_choices, cache=None):
+    """
+    Export the enrollment and demographic fields needed by all reports as raw codes, in one request
+    :param project: RedcapClient to export from
+    :param specs: list of ReportSpec
+    :param grant_choices: dict of grant choice code to label
+    :param protocol_choices: dict of protocol choice code to label
+    :param cache: optional RecordCache of raw codes to report from instead of exporting directly
+    :return: iterator over records
+    """
+    if cache is not None:
+        cache.sync(project)
+        return cache.records(project)
+    grants = {label for spec in specs for label in spec.grants}
+    protocols = {label for spec in specs for label in spec.protocols}
+    payload = record_payload(project, REPORT_FIELDS, raw_or_label='raw')
+    payload['filterLogic'] = build_filter_logic([code for code, label in grant_choices.items() if label in grants],
+                                      [code for code, label in protocol_choices.items() if label in protocols],
+                                      min(spec.start for spec in specs), max(spec.end for spec in specs))
+    return stream_records(project, payload)
+
+
+def file_name(spec):
+    """
+    Csv file name for a report
+    :param spec: ReportSpec
+    :return: file name made of the safe characters of the report name
+    """
+    return re.sub(r'[^\w\-. ]', '_', spec.name) + '.csv'
+
+
+def write_batch(path, specs, tables, combined=False):
+    """
+    Write batch reports, one csv per report in a directory or all reports in one csv
+    :param path: directory to write to, or the csv file if combined
+    :param specs: list of ReportSpec
+    :param tables: list of CountTable, one per spec
+    :param combined: write all reports to the single file path
+    """
+    if combined:
+        with open(path, 'w', newline='') as file:
+            title_writer = csv.writer(file, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+            for spec, counts in zip(specs, tables):
+                title_writer.writerow(['Report:', spec.name, spec.start.isoformat(), spec.end.isoformat()])
+                write_report(file, counts, spec.grants, spec.protocols)
+                title_writer.writerow([])
+    else:
+        os.makedirs(path, exist_ok=True)
+        for spec, counts in zip(specs, tables):
+            with open(os.path.join(path, file_name(spec)), 'w', newline='') as file:
+                write_report(file, counts, spec.grants, spec.protocols)
+
+
+def main(argv=None):
+    """
+    Run batch reports from the command line
+    :param argv: arguments to parse, defaults to sys.argv
+    :return: exit status
+    """
+    parser = argparse.ArgumentParser(prog='python -m batch_report',
+                                     description='Write many NIH cumulative enrollment reports from one export of a '
+                                                 'REDCap project.')
+    parser.add_argument('specs', type=argparse.FileType('r'), help='JSON file of report specs')
+    parser.add_argument('--url', default=DEFAULT_URL, help='REDCap API URL (default: %(default)s)')
+    parser.add_argument('--token', default=os.environ.get('REDCAP_API_TOKEN'),
+                        help='REDCap API token (default: $REDCAP_API_TOKEN)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT[1], metavar='SECONDS',
+                        help='seconds to wait for each read of a REDCap response (default: %(default)s)')
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_PATH, metavar='PATH',
+                        help='report from a local cache of the project (default path: %(const)s)')
+    parser.add_argument('--combined', action='store_true', help='write all reports to one csv file')
+    parser.add_argument('-o', '--output', required=True,
+                        help='directory to write one csv per report to, or the csv file with --combined')
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error('an API token is required, pass --token or set REDCAP_API_TOKEN')
+
+    try:
+        cache = RecordCache(args.cache, raw_or_label='raw', min_sync_interval=0) if args.cache else None
+        project, metadata = connect(args.url, args.token, cache, timeout=(TIMEOUT[0], args.timeout))
+        grant_choices = metadata.choices('grant')
+        protocol_choices = metadata.choices('protocol')
+        with args.specs:
+            specs = load_specs(args.specs, grant_choices, protocol_choices)
+        if not specs:
+            return 0
+        records = export_batch_records(project, specs, grant_choices, protocol_choices, cache)
+        # The export streams as the records are counted, so its errors are raised here
+        tables = compute_batch(records, specs, metadata)
+    except (redcap.RedcapError, ValueError, IOError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    try:
+        write_batch(args.output, specs, tables, args.combined)
+    except IOError as e:
+        print("Can't save file: {}".format(e), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
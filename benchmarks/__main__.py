@@ -0,0 +1,145 @@
+"""
+Time each stage of the report pipeline against synthetic projects served by a fake REDCap API.
+
+Run from the repository root with `python -m benchmarks [--sizes 1000 100000 1000000]`.
+"""
+import argparse
+import datetime
+import io
+import os
+import tempfile
+import time
+
+import multi_project
+import report_export
+import report_pipeline
+from benchmarks.fake_redcap import FIRST_ENROLLMENT, FakeRedcapServer, SyntheticProject
+from enrollment_index import EnrollmentIndex
+from project_metadata import connect
+from tabulation import tabulate
+
+PROJECTS = 3  # Projects the records are split over for the multi-project stages
+RANGES = 100  # Date ranges read off the period counts, as when moving the date pickers
+STAGES = ['metadata', 'enrollment index (all)', 'filter enrollments', 'enrollment export (filtered)',
+          'demographics export', 'tabulation', 'demographics export (raw)', 'tabulation (raw)', 'write_report',
+          'projects one at a time', 'projects combined', 'period counts (combined)',
+          '{} period count ranges'.format(RANGES)] + ['participant extract ({})'.format(extension)
+                                                             for extension in report_export.FORMATS]
+
+
+def timed(results, stage, function, *args, **kwargs):
+    """
+    Call a function and record how long it took
+    :param results: dict of stage name to seconds, updated in place
+    :param stage: name of the stage
+    :param function: function to call
+    :return: return value of the function
+    """
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    results[stage] = time.perf_counter() - start
+    return value
+
+
+def export_all(project, ids, **kwargs):
+    """
+    Export the demographics of records in concurrent chunks into one list, to time the export apart from tabulation
+    :param project: RedcapClient to export from
+    :param ids: record ids to export
+    :param kwargs: passed on to report_pipeline.export_chunks
+    :return: list of records
+    """
+    return [r for records in report_pipeline.export_chunks(project, ids, **kwargs) for r in records]
+
+
+def run(size, seed=0, race_checkbox=False, latency=0.0):
+    """
+    Run every stage of a report against a synthetic project
+    :param size: number of records in the project
+    :param seed: random seed of the project
+    :param race_checkbox: make race a checkbox field in the project
+    :param latency: seconds the fake server waits before answering each request
+    :return: dict of stage name to seconds
+    """
+    results = {}
+    synthetic = SyntheticProject(size, seed=seed, race_checkbox=race_checkbox)
+    # The same number of records split over several projects sharing participants, for the multi-project stages
+    tokens = ['PROJECT{}'.format(i + 1) for i in range(PROJECTS)]
+    split = {token: SyntheticProject(max(size // PROJECTS, 1), seed=seed + i, race_checkbox=race_checkbox,
+                                     participants=size) for i, token in enumerate(tokens)}
+    start = FIRST_ENROLLMENT + datetime.timedelta(days=365)
+    end = FIRST_ENROLLMENT + datetime.timedelta(days=365 * 4)
+
+    with FakeRedcapServer(synthetic, split, latency) as server:
+        project, metadata = timed(results, 'metadata', connect, server.url, 'BENCHMARK')
+        grants = metadata.choices('grant')
+        protocols = metadata.choices('protocol')
+        grant_codes = list(grants)
+        protocol_codes = list(protocols)[:len(protocols) // 2]
+
+        # Every enrollment streamed into an index and filtered locally, as reports from the record cache do
+        payload = report_pipeline.record_payload(project, ['enrollment', 'grant', 'protocol'], raw_or_label='raw')
+        index = timed(results, 'enrollment index (all)', EnrollmentIndex,
+                      report_pipeline.stream_records(project, payload), id_field=project.def_field)
+        timed(results, 'filter enrollments', index.select, grant_codes, protocol_codes, start, end)
+        del index
+
+        ids = timed(results, 'enrollment export (filtered)', report_pipeline.export_enrollment_ids, project,
+                    grant_codes, protocol_codes, start, end)
+        participants = timed(results, 'demographics export', export_all, project, ids)
+        counts = timed(results, 'tabulation', tabulate, participants)
+        del participants
+        participants = timed(results, 'demographics export (raw)', export_all, project, ids,
+                             raw_or_label='raw')
+        timed(results, 'tabulation (raw)', tabulate, participants, metadata.demographic_lookups())
+        del participants
+        timed(results, 'write_report', report_pipeline.write_report, io.StringIO(), counts,
+              [grants[c] for c in grant_codes], [protocols[c] for c in protocol_codes])
+
+        sources = multi_project.connect_all(server.url, tokens)
+        grant_sel = [grants[c] for c in grant_codes]
+        protocol_sel = [protocols[c] for c in protocol_codes]
+        start_time = time.perf_counter()
+        for project, metadata in sources:
+            multi_project.participant_cells(project, metadata, grant_sel, protocol_sel, start, end, 'participant_id')
+        results['projects one at a time'] = time.perf_counter() - start_time
+        timed(results, 'projects combined', multi_project.run_combined_report, sources, grant_sel, protocol_sel,
+              start, end, 'participant_id')
+        period_counts, _, _ = timed(results, 'period counts (combined)', multi_project.run_combined_periods, sources,
+                                    grant_sel, protocol_sel, 'participant_id')
+        start_time = time.perf_counter()
+        for i in range(RANGES):
+            period_counts.between(start + datetime.timedelta(days=i), end - datetime.timedelta(days=i))
+        results['{} period count ranges'.format(RANGES)] = time.perf_counter() - start_time
+
+        counts, _, _ = multi_project.run_combined_report(sources, grant_sel, protocol_sel, start, end)
+        with tempfile.TemporaryDirectory() as directory:
+            for extension in report_export.FORMATS:
+                batches = report_export.extract_batches(sources, grant_sel, protocol_sel, start, end)
+                try:
+                    timed(results, 'participant extract ({})'.format(extension), report_export.export_report,
+                          os.path.join(directory, 'participants' + extension), counts, grant_sel, protocol_sel,
+                          batches)
+                except ImportError:
+                    results['participant extract ({})'.format(extension)] = float('nan')  # Optional package missing
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='numbers of records to benchmark (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic projects')
+    parser.add_argument('--checkbox-race', action='store_true', help='make race a checkbox field of the projects')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake REDCap API waits before each answer, to mimic a distant server')
+    args = parser.parse_args(argv)
+
+    print('{:<30}'.format('stage (seconds)') + ''.join('{:>12}'.format(size) for size in args.sizes))
+    results = [run(size, args.seed, args.checkbox_race, args.latency) for size in args.sizes]
+    for stage in STAGES:
+        print('{:<30}'.format(stage) + ''.join('{:>12.3f}'.format(r[stage]) for r in results))
+
+
+if __name__ == '__main__':
+    main()
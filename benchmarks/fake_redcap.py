@@ -0,0 +1,247 @@
+"""
+Synthetic REDCap project served from a local fake REDCap API endpoint, for benchmarking the report pipeline
+"""
+import csv
+import datetime
+import io
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from tabulation import RACES, ETHNICITIES, GENDERS
+
+FIRST_ENROLLMENT = datetime.date(2015, 1, 1)
+JSON = 'application/json'
+
+
+def choices(labels):
+    """
+    Choices of a multiple choice field coded 1..n
+    :param labels: choice labels
+    :return: dict of choice code to label
+    """
+    return {str(i + 1): label for i, label in enumerate(labels)}
+
+
+class SyntheticProject:
+    """
+    Randomly generated project with enrollment, grant, protocol, race, gender and ethnicity fields.
+    Field values are held as integer arrays and only turned into records when exported.
+    """
+
+    def __init__(self, size, grants=5, protocols=10, days=365 * 6, seed=0, race_checkbox=False, participants=None):
+        """
+        :param size: number of records
+        :param grants: number of grant choices
+        :param protocols: number of protocol choices
+        :param days: number of days over which enrollments are spread, starting at FIRST_ENROLLMENT
+        :param seed: random seed
+        :param race_checkbox: make race a checkbox field of the single races, rather than a dropdown of RACES
+        :param participants: if given, add a participant_id field drawn from this many ids, so projects built with
+            the same number share participants
+        """
+        rng = np.random.default_rng(seed)
+        self.size = size
+        self.choices = {
+            'grant': choices(['Grant {}'.format(i + 1) for i in range(grants)]),
+            'protocol': choices(['Protocol {}'.format(i + 1) for i in range(protocols)]),
+            'race': choices([r for r in RACES if r != 'More Than One Race'] if race_checkbox else RACES),
+            'ethnicity': choices(ETHNICITIES),
+            'gender': choices(GENDERS),
+        }
+        self.values = {field: rng.integers(1, len(c) + 1, size) for field, c in self.choices.items()}
+        self.values['enrollment'] = rng.integers(0, days, size) + FIRST_ENROLLMENT.toordinal()
+        self.race_checkbox = race_checkbox
+        if race_checkbox:
+            # One column per race choice, most participants ticking a single box
+            self.values['race'] = rng.random((size, len(self.choices['race']))) < 1 / len(self.choices['race'])
+        if participants:
+            self.values['participant_id'] = rng.integers(0, participants, size)
+        self.modified = datetime.datetime.now()
+
+    @property
+    def metadata(self):
+        """
+        Project metadata, with choices in the select_choices_or_calculations format
+        """
+        metadata = [{'field_name': 'record_id', 'form_name': 'enrollment', 'field_type': 'text',
+                     'field_label': 'Record ID', 'select_choices_or_calculations': ''},
+                    {'field_name': 'enrollment', 'form_name': 'enrollment', 'field_type': 'text',
+                     'field_label': 'Enrollment date', 'select_choices_or_calculations': '',
+                     'text_validation_type_or_show_slider_number': 'date_ymd'}]
+        if 'participant_id' in self.values:
+            metadata.append({'field_name': 'participant_id', 'form_name': 'enrollment', 'field_type': 'text',
+                             'field_label': 'Participant ID', 'select_choices_or_calculations': ''})
+        for field, c in self.choices.items():
+            field_type = 'checkbox' if field == 'race' and self.race_checkbox else 'dropdown'
+            metadata.append({'field_name': field, 'form_name': 'enrollment', 'field_type': field_type,
+                             'field_label': field.title(),
+                             'select_choices_or_calculations': ' | '.join('{}, {}'.format(code, label)
+                                                                           for code, label in c.items())})
+        return metadata
+
+    def select(self, filter_logic=None, records=None):
+        """
+        Positions of the records matching an export request
+        :param filter_logic: filterLogic of the form built by report_pipeline.build_filter_logic
+        :param records: record ids to export
+        :return: integer array of record positions
+        """
+        mask = np.ones(self.size, dtype=bool)
+        if records is not None:
+            mask[:] = False
+            mask[[int(r) - 1 for r in records]] = True
+        if filter_logic:
+            for field in ('grant', 'protocol'):
+                codes = [int(c) for c in re.findall(r"\[{}\] = '(\d+)'".format(field), filter_logic)]
+                if codes:
+                    mask &= np.isin(self.values[field], codes)
+            for op, value in re.findall(r"\[enrollment\] (>=|<) '([\d-]+)'", filter_logic):
+                day = datetime.date.fromisoformat(value).toordinal()
+                mask &= self.values['enrollment'] >= day if op == '>=' else self.values['enrollment'] < day
+        return np.flatnonzero(mask)
+
+    def columns(self, fields):
+        """
+        Names of the exported columns of fields, with a race___<code> column per choice of a checkbox race
+        :param fields: fields to export
+        :return: list of column names
+        """
+        if not self.race_checkbox:
+            return list(fields)
+        return [column for field in fields
+                for column in (['race___{}'.format(code) for code in self.choices['race']] if field == 'race'
+                               else [field])]
+
+    def export(self, fields, positions, raw_or_label='raw'):
+        """
+        Build exported records
+        :param fields: fields to export
+        :param positions: positions of the records to export
+        :param raw_or_label: 'raw' or 'label'
+        :return: list of record dicts
+        """
+        columns = []
+        for field in fields:
+            if field == 'race' and self.race_checkbox:
+                for i in range(len(self.choices[field])):
+                    ticked = self.values[field][positions, i]
+                    columns.append(np.where(ticked, 'Checked', 'Unchecked') if raw_or_label == 'label' else
+                                   np.where(ticked, '1', '0'))
+                continue
+            if field == 'record_id':
+                column = (positions + 1).astype(str)
+            elif field == 'participant_id':
+                column = ['P{}'.format(p) for p in self.values[field][positions]]
+            elif field == 'enrollment':
+                column = [datetime.date.fromordinal(int(d)).isoformat() for d in self.values[field][positions]]
+            elif raw_or_label == 'label':
+                labels = np.array([''] + list(self.choices[field].values()), dtype=object)
+                column = labels[self.values[field][positions]]
+            else:
+                column = self.values[field][positions].astype(str)
+            columns.append(column)
+        names = self.columns(fields)
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+class FakeRedcapServer:
+    """
+    Local HTTP server answering the REDCap API calls made by the report, from a SyntheticProject
+    """
+
+    def __init__(self, project, projects=None, latency=0.0):
+        """
+        :param project: SyntheticProject to serve
+        :param projects: optional dict of API token to SyntheticProject, to serve several projects. Other tokens are
+            answered from project.
+        :param latency: seconds to wait before answering each request, to mimic a distant server
+        """
+        self.project = project
+        self.projects = projects or {}
+        self.latency = latency
+        self.bytes_sent = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = 'http://127.0.0.1:{}/api/'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, params):
+        """
+        Answer an API request
+        :param params: dict of request parameters
+        :return: response body, and its content type
+        """
+        project = self.projects.get(params.get('token'), self.project)
+        content = params.get('content')
+        if content == 'version':
+            return '10.0.0', 'text/html'
+        if content in ('event', 'arm'):
+            return json.dumps({'error': 'You cannot export {}s for classic projects'.format(content)}), JSON
+        if content == 'metadata':
+            fields = indexed(params, 'fields')
+            return json.dumps([f for f in project.metadata if not fields or f['field_name'] in fields]), JSON
+        if content == 'record':
+            fields = indexed(params, 'fields') or ['record_id'] + list(project.values)
+            records = indexed(params, 'records') or None
+            if params.get('dateRangeBegin') and datetime.datetime.strptime(
+                    params['dateRangeBegin'], '%Y-%m-%d %H:%M:%S') > project.modified:
+                positions = np.zeros(0, dtype=np.int64)
+            else:
+                positions = project.select(params.get('filterLogic'), records)
+            exported = project.export(fields, positions, params.get('rawOrLabel', 'raw'))
+            if params.get('format') == 'csv':
+                out = io.StringIO()
+                writer = csv.DictWriter(out, fieldnames=project.columns(fields), lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(exported)
+                return out.getvalue(), 'text/csv'
+            return json.dumps(exported), JSON
+        return json.dumps({'error': 'Unsupported content {}'.format(content)}), JSON
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+                params = {k: v[0] for k, v in urllib.parse.parse_qs(body, keep_blank_values=True).items()}
+                time.sleep(server.latency)
+                response, content_type = server.respond(params)
+                response = response.encode('utf-8')
+                server.bytes_sent += len(response)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+        return Handler
+
+
+def indexed(params, name):
+    """
+    Values of an array parameter sent as name[0], name[1], ...
+    :param params: dict of request parameters
+    :param name: name of the array parameter
+    :return: list of values in index order
+    """
+    values = []
+    while '{}[{}]'.format(name, len(values)) in params:
+        values.append(params['{}[{}]'.format(name, len(values))])
+    return values
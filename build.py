@@ -1,8 +1,25 @@
+"""
+Build the application with PyInstaller. Run with `python build.py`, or `python build.py --onedir` to build a folder
+instead of a single executable. A single executable unpacks itself to a temporary folder on every launch, so the
+folder build starts faster, especially from a shared drive.
+"""
+import argparse
+
 import PyInstaller.__main__
 
+# Modules reachable through optional imports of the dependencies (e.g. PyCap's pandas support) which the app never
+# loads, left out to shrink the build and the unpacking on every launch
+EXCLUDED_MODULES = ['pandas', 'matplotlib', 'scipy', 'IPython', 'tkinter', 'PIL', 'benchmarks']
+
+parser = argparse.ArgumentParser(prog='python build.py', description='Build the NIH_Report executable.')
+parser.add_argument('--onedir', action='store_true', help='build a folder rather than a single executable')
+args = parser.parse_args()
+
 PyInstaller.__main__.run([
     '--name=NIH_Report',
     '--windowed',
-    '--onefile',
+    '--onedir' if args.onedir else '--onefile',
+    '--noupx',  # Compressed binaries have to be decompressed on every launch
+    *['--exclude-module={}'.format(module) for module in EXCLUDED_MODULES],
     'report_app.py'
 ])
@@ -0,0 +1,94 @@
+"""
+Index of enrollments sorted by date, for selecting the records matching the report options without rescanning them
+"""
+import datetime
+
+import numpy as np
+
+
+def parse_date(value):
+    """
+    Parse the date part of a REDCap date or datetime value
+    :param value: value such as '2020-07-01' or '2020-07-01 13:45'
+    :return: datetime.date, or None if the value is not a date
+    """
+    try:
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+class EnrollmentIndex:
+    """
+    Enrollment dates parsed once into a sorted array of day ordinals, with the record id, grant and protocol of
+    each enrollment kept alongside. A date range is selected by binary search, and grants/protocols by their
+    integer codes within that range.
+    """
+
+    def __init__(self, enrollments, id_field='record_id'):
+        """
+        :param enrollments: records with enrollment, grant and protocol fields. Records missing any of them are
+            left out of the index.
+        :param id_field: name of the record id field
+        """
+        self.grant_codes = {}
+        self.protocol_codes = {}
+        ids = []
+        dates = []
+        grants = []
+        protocols = []
+        for e in enrollments:
+            if e.get('grant') and e.get('protocol') and e.get('enrollment'):
+                enrollment = parse_date(e['enrollment'])
+                if enrollment:
+                    ids.append(e.get(id_field))
+                    dates.append(enrollment.toordinal())
+                    grants.append(self.grant_codes.setdefault(e['grant'], len(self.grant_codes)))
+                    protocols.append(self.protocol_codes.setdefault(e['protocol'], len(self.protocol_codes)))
+
+        order = np.argsort(np.asarray(dates, dtype=np.int32), kind='stable')
+        self.dates = np.asarray(dates, dtype=np.int32)[order]
+        self.ids = np.asarray(ids, dtype=object)[order]
+        self.grants = np.asarray(grants, dtype=np.int32)[order]
+        self.protocols = np.asarray(protocols, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def date_range(self, start, end):
+        """
+        Positions of the first and one past the last enrollment within a date range
+        :param start: first enrollment date to include, or None for every enrollment
+        :param end: last enrollment date to include, or None for every enrollment
+        :return: (first, last) slice bounds into the index arrays
+        """
+        if start is None or end is None:
+            return 0, len(self.dates)
+        return (int(np.searchsorted(self.dates, start.toordinal(), side='left')),
+                int(np.searchsorted(self.dates, end.toordinal(), side='right')))
+
+    def mask(self, grant_sel, protocol_sel, first=0, last=None):
+        """
+        Boolean mask of the enrollments between first and last matching the grant and protocol selection
+        :param grant_sel: grant values to include
+        :param protocol_sel: protocol values to include
+        :param first: first position to consider
+        :param last: one past the last position to consider, defaults to the end of the index
+        :return: boolean array of length last - first
+        """
+        grants = [self.grant_codes[g] for g in set(grant_sel) if g in self.grant_codes]
+        protocols = [self.protocol_codes[p] for p in set(protocol_sel) if p in self.protocol_codes]
+        return (np.isin(self.grants[first:last], grants) &
+                np.isin(self.protocols[first:last], protocols))
+
+    def select(self, grant_sel, protocol_sel, start, end):
+        """
+        Record ids of the enrollments matching the selection
+        :param grant_sel: grant values to include
+        :param protocol_sel: protocol values to include
+        :param start: first enrollment date to include, or None for every enrollment
+        :param end: last enrollment date to include, or None for every enrollment
+        :return: list of record ids, ordered by enrollment date
+        """
+        first, last = self.date_range(start, end)
+        return self.ids[first:last][self.mask(grant_sel, protocol_sel, first, last)].tolist()
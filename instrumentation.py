@@ -0,0 +1,198 @@
+"""
+Timing of the stages of a report, with the records handled and bytes received in each, and optional profiling
+"""
+import contextlib
+import cProfile
+import pstats
+import threading
+import time
+
+_task_profiles = None  # Profiles of the worker thread tasks of the running profiled call, if any
+
+
+class Stage:
+    """
+    Totals of one named stage, over every time it ran
+    """
+
+    def __init__(self, name):
+        """
+        :param name: name of the stage
+        """
+        self.name = name
+        self.seconds = 0.0
+        self.records = 0
+        self.bytes = 0
+        self.calls = 0
+
+
+class _Clock:
+    """
+    Seconds of a block, less the seconds of the blocks timed within it on the same thread
+    """
+
+    def __init__(self, running):
+        """
+        :param running: clocks running on the thread, innermost last
+        """
+        self.running = running
+        self.nested = 0.0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.running.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.running.remove(self)
+        if self.running:
+            self.running[-1].nested += elapsed
+        self.seconds = elapsed - self.nested
+
+
+class Timings:
+    """
+    Seconds spent, records handled and bytes received in each stage of a report, in the order the stages first ran.
+    Stages may be timed from several threads. A stage timed within another on the same thread, including the items
+    fetched by iterate, is left out of the enclosing stage's seconds, so a stage pulling records from a streaming
+    export does not count the export again.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._threads = threading.local()
+
+    def _clock(self):
+        if not hasattr(self._threads, 'running'):
+            self._threads.running = []
+        return _Clock(self._threads.running)
+
+    def _stage(self, name):
+        with self._lock:
+            return self.stages.setdefault(name, Stage(name))
+
+    def _add(self, stage, seconds, records=0, received=0):
+        with self._lock:
+            stage.seconds += seconds
+            stage.records += records
+            stage.bytes += received
+            stage.calls += 1
+
+    @contextlib.contextmanager
+    def stage(self, name, project=None):
+        """
+        Time the enclosed block as a stage. Record counts are added by setting .records on the yielded Stage.
+        :param name: name of the stage, adding to its totals if it already ran
+        :param project: optional RedcapClient whose bytes received during the block are added to the stage
+        :return: context manager yielding a Stage for the records of this run
+        """
+        stage = self._stage(name)
+        run = Stage(name)
+        received = project.bytes_received if project is not None else 0
+        clock = self._clock()
+        try:
+            with clock:
+                yield run
+        finally:
+            received = project.bytes_received - received if project is not None else 0
+            self._add(stage, clock.seconds, run.records, received)
+
+    def iterate(self, name, iterable, project=None, size=None):
+        """
+        Time the fetching of the items of an iterable as a stage, leaving out the time the caller spends on them
+        :param name: name of the stage
+        :param iterable: iterable to time, e.g. a generator of exported records
+        :param project: optional RedcapClient whose bytes received until the iterable is exhausted are added to the
+            stage
+        :param size: optional function giving the number of records in an item, 1 per item if not given
+        :return: iterator over the items
+        """
+        stage = self._stage(name)
+        seconds = 0.0
+        records = 0
+        received = project.bytes_received if project is not None else 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                clock = self._clock()
+                try:
+                    with clock:
+                        item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += clock.seconds
+                records += size(item) if size else 1
+                yield item
+        finally:
+            received = project.bytes_received - received if project is not None else 0
+            self._add(stage, seconds, records, received)
+
+    def finish(self):
+        """
+        Stop the wall clock of the report
+        """
+        self.finished = time.perf_counter()
+
+    def report(self):
+        """
+        Table of the stage totals, to show or attach to a ticket
+        :return: text with one line per stage and a total line
+        """
+        lines = ['{:<28}{:>10}{:>8}{:>12}{:>14}'.format('stage', 'seconds', 'calls', 'records', 'bytes')]
+        with self._lock:
+            for s in self.stages.values():
+                lines.append('{:<28}{:>10.3f}{:>8}{:>12}{:>14}'.format(s.name, s.seconds, s.calls, s.records,
+                                                                       s.bytes))
+        lines.append('{:<28}{:>10.3f}'.format('total (wall clock)',
+                                              (self.finished or time.perf_counter()) - self.started))
+        return '\n'.join(lines)
+
+
+def profiled(path, function, *args, **kwargs):
+    """
+    Call a function under cProfile, dumping the profile for pstats or snakeviz. cProfile only profiles the thread it
+    runs on, so tasks the function runs on worker threads are profiled separately through profiled_task and merged
+    into the dump.
+    :param path: file to dump the profile to
+    :param function: function to call
+    :return: return value of the function
+    """
+    global _task_profiles
+    outer, _task_profiles = _task_profiles, []
+    tasks = _task_profiles
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        _task_profiles = outer
+        stats = pstats.Stats(profile)
+        for task in tasks:
+            stats.add(task)
+        stats.dump_stats(path)
+
+
+def profiled_task(function):
+    """
+    Wrap a function to run on a worker thread, such as a ThreadPoolExecutor task, so it is profiled along with
+    the profiled call it is started from. Outside a profiled call the function is returned as it is.
+    :param function: function to wrap
+    :return: function taking the same arguments
+    """
+    tasks = _task_profiles
+    if tasks is None:
+        return function
+
+    def task(*args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            tasks.append(profile)
+
+    return task
@@ -0,0 +1,235 @@
+"""
+Reports combined over several REDCap projects. The projects are exported concurrently and tabulated separately,
+then their participants are merged into one table, counting participants enrolled in more than one project once.
+"""
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from enrollment_index import EnrollmentIndex, parse_date
+from instrumentation import Timings, profiled_task
+from period_counts import KeyedPeriodCounts, PeriodCounts
+from project_metadata import connect
+from report_pipeline import DEMOGRAPHIC_FIELDS, export_chunks, export_enrollment_ids
+from tabulation import cell_codes, count_cells
+
+
+def connect_all(url, tokens, cache=None, **kwargs):
+    """
+    Connect to several REDCap projects at once
+    :param url: REDCap API URL
+    :param tokens: REDCap API tokens of the projects
+    :param cache: optional RecordCache to keep the metadata in
+    :param kwargs: passed on to project_metadata.connect
+    :return: list of (RedcapClient, ProjectMetadata), in the order of tokens
+    """
+    with ThreadPoolExecutor(max_workers=max(len(tokens), 1)) as executor:
+        return list(executor.map(profiled_task(lambda token: connect(url, token, cache, **kwargs)), tokens))
+
+
+def combined_choices(sources, field):
+    """
+    Labels of a multiple choice field across projects, which may code them differently
+    :param sources: list of (project, ProjectMetadata)
+    :param field: name of the field
+    :return: list of labels, in the order they first appear
+    """
+    return list(dict.fromkeys(label for _, metadata in sources for label in metadata.choices(field).values()))
+
+
+def selected_records(project, metadata, grant_sel, protocol_sel, start, end, key_field=None, cache=None,
+                     index=None, timings=None, progress=None, fields=DEMOGRAPHIC_FIELDS + ['enrollment']):
+    """
+    Export the records of one project matching the selection as raw codes
+    :param project: RedcapClient to export from
+    :param metadata: ProjectMetadata of the project
+    :param grant_sel: labels of the grants to include. Labels which are not choices of the project are ignored.
+    :param protocol_sel: labels of the protocols to include
+    :param start: first enrollment date to include, or None for every enrollment
+    :param end: last enrollment date to include, or None for every enrollment
+    :param key_field: optional field identifying a participant across projects, exported along with fields
+    :param cache: optional RecordCache of raw codes to report from. It is only used if it holds key_field.
+    :param index: EnrollmentIndex of the cached records returned by an earlier call, reused if the cache has not
+        been synced since
+    :param timings: optional Timings to add the stages of the export to
+    :param progress: optional function called with a message, and the number of chunks exported and in total
+    :param fields: fields to export when not reading from the cache, which holds every report field
+    :return: iterator over the records, and the EnrollmentIndex of the cached records (None without a cache)
+    """
+    if timings is None:
+        timings = Timings()
+    grant_codes = [c for c in (metadata.code('grant', label) for label in grant_sel) if c is not None]
+    protocol_codes = [c for c in (metadata.code('protocol', label) for label in protocol_sel) if c is not None]
+
+    if cache is not None and (key_field is None or key_field in cache.fields):
+        if progress:
+            progress('Updating cached records')
+        with timings.stage('cache sync', project):
+            synced = cache.sync(project)
+        if synced or index is None:
+            with timings.stage('enrollment index') as stage:
+                index = EnrollmentIndex(cache.records(project), id_field=project.def_field)
+                stage.records = len(index)
+        with timings.stage('filter enrollments') as stage:
+            ids = index.select(grant_codes, protocol_codes, start, end)
+            stage.records = len(ids)
+        return timings.iterate('cache reads', cache.records(project, ids)), index
+
+    if progress:
+        progress('Exporting enrollments')
+    with timings.stage('enrollment export', project) as stage:
+        ids = export_enrollment_ids(project, grant_codes, protocol_codes, start, end)
+        stage.records = len(ids)
+    if progress:
+        progress('Exporting demographics')
+    chunks = export_chunks(project, ids, fields + [key_field] if key_field else fields, raw_or_label='raw',
+                           progress=progress and (lambda done, total: progress('Exporting demographics', done, total)))
+    return (r for chunk in timings.iterate('demographics export', chunks, project, size=len) for r in chunk), index
+
+
+def enrolled(records):
+    """
+    Pair records with their enrollment date, leaving out records without one. Longitudinal projects export a row
+    per event, and only the event holding the enrollment stands for the participant.
+    :param records: iterable of record dicts
+    :return: iterator over (enrollment date as a day ordinal, record)
+    """
+    for r in records:
+        enrollment = parse_date(r.get('enrollment') or '')
+        if enrollment:
+            yield enrollment.toordinal(), r
+
+
+def participant_cells(project, metadata, grant_sel, protocol_sel, start, end, key_field=None, cache=None,
+                      index=None, timings=None, progress=None):
+    """
+    Export the participants of one project matching the selection and find their cells of the count cube
+    :param project: RedcapClient to export from
+    :param metadata: ProjectMetadata of the project
+    :param grant_sel: labels of the grants to include, see selected_records
+    :param protocol_sel: labels of the protocols to include
+    :param start: first enrollment date to include, or None for every enrollment
+    :param end: last enrollment date to include, or None for every enrollment
+    :param key_field: optional field identifying a participant across projects
+    :param cache: optional RecordCache of raw codes to report from. It is only used if it holds key_field.
+    :param index: EnrollmentIndex of the cached records returned by an earlier call, or None
+    :param timings: optional Timings to add the stages of the report to
+    :param progress: optional function called with a message, and the number of chunks exported and in total
+    :return: cells as from tabulation.cell_codes, enrollment dates as day ordinals, participant keys (None without
+        key_field) and the EnrollmentIndex of the cached records (None without a cache)
+    """
+    if timings is None:
+        timings = Timings()
+    records, index = selected_records(project, metadata, grant_sel, protocol_sel, start, end, key_field, cache,
+                                      index, timings, progress)
+    dates = []
+    keys = [] if key_field else None
+
+    def collected(records):
+        # Collect the enrollment date and key of each participant as the records are counted
+        for enrollment, r in enrolled(records):
+            dates.append(enrollment)
+            if key_field:
+                keys.append(r.get(key_field, '').strip() or None)
+            yield r
+
+    with timings.stage('tabulation') as stage:
+        cells = cell_codes(collected(records), metadata.demographic_lookups())
+        stage.records = len(cells)
+    return cells, np.asarray(dates, dtype=np.int64), keys, index
+
+
+def merge_period_counts(results):
+    """
+    Count the participants of several projects by enrollment day, counting participants with the same key once
+    :param results: list of (cells, dates, keys) per project, with keys None if participants are not matched across
+        projects. Participants with a key of None are always counted.
+    :return: PeriodCounts of the merged participants, or KeyedPeriodCounts if they are matched by key. A participant
+        enrolled in a date range is counted once in it, with the demographics of their earliest enrollment in the
+        range, the first project's on the same day.
+    """
+    cells = np.concatenate([c for c, _, _ in results] or [np.zeros(0, dtype=np.int64)])
+    dates = np.concatenate([d for _, d, _ in results] or [np.zeros(0, dtype=np.int64)])
+    if all(keys is None for _, _, keys in results):
+        return PeriodCounts(dates, cells)
+    keys = list(itertools.chain.from_iterable(keys if keys is not None else [None] * len(c)
+                                              for c, _, keys in results))
+    return KeyedPeriodCounts(dates, cells, keys)
+
+
+def fetch_all(sources, grant_sel, protocol_sel, start, end, key_field=None, cache=None, indexes=None,
+              timings=None, progress=None):
+    """
+    Export the participants matching the selection from several projects at once, see participant_cells
+    :param sources: list of (RedcapClient, ProjectMetadata)
+    :param indexes: EnrollmentIndex per source returned by an earlier call, or None
+    :param progress: optional function called with a message, and the number of chunks exported and in total
+    :return: list of (cells, dates, keys, index) per source
+    """
+    indexes = indexes or [None] * len(sources)
+
+    def fetch(i):
+        project, metadata = sources[i]
+
+        def project_progress(message, done=0, total=0):
+            progress('{} (project {} of {})'.format(message, i + 1, len(sources)), done, total)
+
+        return participant_cells(project, metadata, grant_sel, protocol_sel, start, end, key_field, cache,
+                                 indexes[i], timings, project_progress if progress else None)
+
+    with ThreadPoolExecutor(max_workers=max(len(sources), 1)) as executor:
+        return list(executor.map(profiled_task(fetch), range(len(sources))))
+
+
+def run_combined_report(sources, grant_sel, protocol_sel, start, end, key_field=None, cache=None, indexes=None,
+                        timings=None, progress=None):
+    """
+    Count the participants matching the selection across several projects, exporting from all of them at once
+    :param sources: list of (RedcapClient, ProjectMetadata)
+    :param grant_sel: labels of the grants to include
+    :param protocol_sel: labels of the protocols to include
+    :param start: first enrollment date to include
+    :param end: last enrollment date to include
+    :param key_field: optional field identifying a participant across projects, to count participants enrolled
+        more than once in the date range once, see merge_period_counts
+    :param cache: optional RecordCache of raw codes to report from, see participant_cells
+    :param indexes: EnrollmentIndex per source returned by an earlier call, or None
+    :param timings: optional Timings to add the stages of every project to
+    :param progress: optional function called with a message, and the number of chunks exported and in total
+    :return: merged CountTable, list of the CountTable of each project before merging, and the EnrollmentIndex
+        of each project for the next call
+    """
+    results = fetch_all(sources, grant_sel, protocol_sel, start, end, key_field, cache, indexes, timings, progress)
+    if key_field:
+        merged = merge_period_counts([(cells, dates, keys) for cells, dates, keys, _ in results]).between(start, end)
+    else:
+        merged = count_cells(np.concatenate([cells for cells, _, _, _ in results] or [np.zeros(0, dtype=np.int64)]))
+    return merged, [count_cells(cells) for cells, _, _, _ in results], [index for _, _, _, index in results]
+
+
+def run_combined_periods(sources, grant_sel, protocol_sel, key_field=None, cache=None, indexes=None, timings=None,
+                         progress=None):
+    """
+    Count the participants matching a grant and protocol selection across several projects by enrollment day, so
+    the table of any date range can be read off without exporting again
+    :param sources: list of (RedcapClient, ProjectMetadata)
+    :param grant_sel: labels of the grants to include
+    :param protocol_sel: labels of the protocols to include
+    :param key_field: optional field identifying a participant across projects, to count them once within any date
+        range, see merge_period_counts
+    :param cache: optional RecordCache of raw codes to report from, see participant_cells
+    :param indexes: EnrollmentIndex per source returned by an earlier call, or None
+    :param timings: optional Timings to add the stages of every project to
+    :param progress: optional function called with a message, and the number of chunks exported and in total
+    :return: merged PeriodCounts, list of the PeriodCounts of each project before merging, and the
+        EnrollmentIndex of each project for the next call
+    """
+    if timings is None:
+        timings = Timings()
+    results = fetch_all(sources, grant_sel, protocol_sel, None, None, key_field, cache, indexes, timings, progress)
+    with timings.stage('period counts') as stage:
+        merged = merge_period_counts([(cells, dates, keys) for cells, dates, keys, _ in results])
+        projects = [PeriodCounts(dates, cells) for cells, dates, _, _ in results]
+        stage.records = len(merged)
+    return merged, projects, [index for _, _, _, index in results]
@@ -0,0 +1,165 @@
+"""
+Counts of participants by enrollment day kept as running totals, so the count table of any date range, month or
+quarter is the difference of two precomputed cubes instead of a recount of the records
+"""
+import datetime
+
+import numpy as np
+
+from tabulation import CELLS, ETHNICITIES, GENDERS, RACES, CountTable, count_cells
+
+PERIODS = ('month', 'quarter')
+
+
+def period_start(day, period='month'):
+    """
+    First day of the month or quarter holding a day
+    :param day: datetime.date
+    :param period: 'month' or 'quarter'
+    :return: datetime.date
+    """
+    if period == 'quarter':
+        return datetime.date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+    return day.replace(day=1)
+
+
+def next_period(day, period='month'):
+    """
+    First day of the month or quarter after the one starting on a day
+    :param day: first day of a period, as from period_start
+    :param period: 'month' or 'quarter'
+    :return: datetime.date
+    """
+    month = day.month + (3 if period == 'quarter' else 1)
+    return datetime.date(day.year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+def period_label(day, period='month'):
+    """
+    Name of the month or quarter holding a day
+    :param day: datetime.date
+    :param period: 'month' or 'quarter'
+    :return: label such as '2020-07' or '2020 Q3'
+    """
+    if period == 'quarter':
+        return '{} Q{}'.format(day.year, (day.month - 1) // 3 + 1)
+    return '{}-{:02}'.format(day.year, day.month)
+
+
+def period_ranges(start, end, period='month'):
+    """
+    Split a date range into months or quarters, with the first and last cut to the range
+    :param start: first date of the range
+    :param end: last date of the range
+    :param period: 'month' or 'quarter'
+    :return: list of (label, first date, last date)
+    """
+    ranges = []
+    first = period_start(start, period)
+    while first <= end:
+        following = next_period(first, period)
+        ranges.append((period_label(first, period), max(first, start),
+                       min(following - datetime.timedelta(days=1), end)))
+        first = following
+    return ranges
+
+
+class PeriodCounts:
+    """
+    Participants counted into one race x ethnicity x gender cube per enrollment day, stored as running totals over
+    the days. Slot 0 of each cube counts participants whose demographics match no category, so totals stay right.
+    """
+
+    def __init__(self, dates, cells):
+        """
+        :param dates: integer array of each participant's enrollment date, as day ordinals
+        :param cells: integer array of each participant's cell, as from tabulation.cell_codes
+        """
+        dates = np.asarray(dates, dtype=np.int64)
+        cells = np.asarray(cells, dtype=np.int64)
+        # Only the days with enrollments get a row, so a far-off mistyped date does not fill in the years between
+        self.days = np.unique(dates)
+        daily = np.bincount(np.searchsorted(self.days, dates) * (CELLS + 1) + cells + 1,
+                            minlength=len(self.days) * (CELLS + 1)).reshape((len(self.days), CELLS + 1))
+        # Row d holds the counts of the enrollments before days[d]
+        self.cumulative = np.zeros((len(self.days) + 1, CELLS + 1), dtype=np.int32)
+        np.cumsum(daily, axis=0, out=self.cumulative[1:])
+
+    def __len__(self):
+        return int(self.cumulative[-1].sum())
+
+    def _row(self, ordinal):
+        """
+        Row of the running totals counting the enrollments before a day
+        :param ordinal: day ordinal
+        :return: row position
+        """
+        return int(np.searchsorted(self.days, ordinal))
+
+    def between(self, start, end):
+        """
+        Count the participants enrolled within a date range
+        :param start: first enrollment date to include
+        :param end: last enrollment date to include
+        :return: CountTable of the participants
+        """
+        counts = (self.cumulative[self._row(end.toordinal() + 1)] -
+                  self.cumulative[self._row(start.toordinal())]).astype(np.int64)
+        return CountTable(counts[1:].reshape((len(RACES), len(ETHNICITIES), len(GENDERS))),
+                          total=int(counts.sum()))
+
+    def periods(self, start, end, period='month'):
+        """
+        Count the participants enrolled in each month or quarter of a date range, and in the range up to the end of
+        each period
+        :param start: first enrollment date to include
+        :param end: last enrollment date to include
+        :param period: 'month' or 'quarter'
+        :return: list of (label, first date, last date, CountTable of the period, cumulative CountTable to date)
+        """
+        return [(label, first, last, self.between(first, last), self.between(start, last))
+                for label, first, last in period_ranges(start, end, period)]
+
+
+class KeyedPeriodCounts(PeriodCounts):
+    """
+    Enrollments of participants who may be enrolled more than once, counting each participant once within a date
+    range, with the demographics of their earliest enrollment in it. Which enrollment that is depends on the range,
+    so the counts of a range are not a difference of running totals. Instead each enrollment keeps the date of the
+    participant's enrollment before it, and a range counts the enrollments in it whose previous one is before it.
+    """
+
+    def __init__(self, dates, cells, keys):
+        """
+        :param dates: integer array of each enrollment's date, as day ordinals
+        :param cells: integer array of each enrollment's cell, as from tabulation.cell_codes
+        :param keys: participant key of each enrollment. Enrollments with a key of None are always counted.
+            Enrollments of a participant on the same day are ordered as given.
+        """
+        codes = {}
+        keys = np.fromiter((codes.setdefault(('key', key) if key is not None else ('position', i), len(codes))
+                            for i, key in enumerate(keys)), dtype=np.int64, count=len(keys))
+        order = np.argsort(np.asarray(dates, dtype=np.int64), kind='stable')
+        self.dates = np.asarray(dates, dtype=np.int64)[order]
+        self.cells = np.asarray(cells, dtype=np.int64)[order]
+        self.participants = len(codes)
+        # Enrollments by participant, each participant's in date order, to find the enrollment before each one
+        keys = keys[order]
+        by_key = np.argsort(keys, kind='stable')
+        same = keys[by_key[1:]] == keys[by_key[:-1]]
+        self.previous = np.full(len(self.dates), np.iinfo(np.int64).min, dtype=np.int64)
+        self.previous[by_key[1:][same]] = self.dates[by_key[:-1][same]]
+
+    def __len__(self):
+        return self.participants
+
+    def between(self, start, end):
+        """
+        Count the participants enrolled within a date range, each once
+        :param start: first enrollment date to include
+        :param end: last enrollment date to include
+        :return: CountTable of the participants
+        """
+        first = int(np.searchsorted(self.dates, start.toordinal()))
+        last = int(np.searchsorted(self.dates, end.toordinal(), side='right'))
+        return count_cells(self.cells[first:last][self.previous[first:last] < start.toordinal()])
@@ -0,0 +1,159 @@
+"""
+Project metadata, loaded once per connection and kept in the local cache between connections
+"""
+import datetime
+
+import redcap
+from redcap.request import RequestException
+
+from record_cache import SYNC_OVERLAP
+from redcap_client import RedcapClient
+from tabulation import RaceCheckboxes, raw_lookups
+
+CHOICE_FIELD_TYPES = ('dropdown', 'radio', 'checkbox')
+# Used when the project's design log can't be read to tell whether cached metadata is still current
+METADATA_MAX_AGE = datetime.timedelta(days=1)
+LOG_TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def parse_choices(choices):
+    """
+    Parse a REDCap select_choices_or_calculations string such as '1, Grant A | 2, Grant B'
+    :param choices: choices string from the project metadata
+    :return: dict of choice code to label, in the order given
+    """
+    parsed = {}
+    for choice in choices.split('|'):
+        code, label = choice.split(',', 1)
+        parsed[code.strip()] = label.strip()
+    return parsed
+
+
+class ProjectMetadata:
+    """
+    Data dictionary of a project, with the choices of every multiple choice field parsed into code/label lookups
+    """
+
+    def __init__(self, fields):
+        """
+        :param fields: metadata exported from REDCap, one dict per field
+        """
+        self.fields = fields
+        self.def_field = fields[0]['field_name']
+        self.field_types = {f['field_name']: f['field_type'] for f in fields}
+        self._choices = {}
+        self._codes = {}
+        for f in fields:
+            if f['field_type'] in CHOICE_FIELD_TYPES and f.get('select_choices_or_calculations'):
+                choices = parse_choices(f['select_choices_or_calculations'])
+                self._choices[f['field_name']] = choices
+                self._codes[f['field_name']] = {label: code for code, label in choices.items()}
+
+    def choices(self, field):
+        """
+        Choices of a multiple choice field
+        :param field: name of the field
+        :return: dict of choice code to label
+        """
+        return self._choices[field]
+
+    def label(self, field, code):
+        """
+        Label of a choice
+        :param field: name of the field
+        :param code: raw choice code
+        :return: label, or None if the code is not a choice of the field
+        """
+        return self._choices[field].get(code)
+
+    def code(self, field, label):
+        """
+        Raw code of a choice
+        :param field: name of the field
+        :param label: choice label
+        :return: code, or None if the label is not a choice of the field
+        """
+        return self._codes[field].get(label)
+
+    def demographic_lookups(self):
+        """
+        Lookups from the raw race, ethnicity and gender codes of this project to category positions
+        :return: (race, ethnicity, gender) lookups for tabulation
+        """
+        lookups = raw_lookups(self.choices('race'), self.choices('ethnicity'), self.choices('gender'))
+        if self.field_types.get('race') == 'checkbox':
+            lookups = (RaceCheckboxes(self.choices('race')),) + lookups[1:]
+        return lookups
+
+    def configure(self, project):
+        """
+        Set up a project created with lazy=True from this metadata instead of exporting it again
+        :param project: redcap.Project
+        """
+        project.metadata = self.fields
+        project.field_names = [f['field_name'] for f in self.fields]
+        project.def_field = self.def_field
+        project.field_labels = [f['field_label'] for f in self.fields]
+        project.forms = tuple(set(f['form_name'] for f in self.fields))
+
+
+def design_changed_since(project, since):
+    """
+    Check the project's design log for changes
+    :param project: redcap.Project
+    :param since: datetime.datetime to check from, in local time. REDCap compares it against server time, so the log
+        is read from SYNC_OVERLAP earlier, as for record syncs.
+    :return: whether the design changed, or None if the log could not be read
+    """
+    payload = {'token': project.token, 'content': 'log', 'format': 'json', 'logtype': 'manage',
+               'beginTime': (since - SYNC_OVERLAP).strftime(LOG_TIME_FORMAT)}
+    try:
+        log = project._call_api(payload, None)[0]
+    except (RequestException, ValueError):
+        return None
+    if not isinstance(log, list):
+        return None  # Logging API not available, or the token lacks logging rights
+    return len(log) > 0
+
+
+def load_metadata(project, cache=None):
+    """
+    Load the metadata of a project, from the cache if it is still current
+    :param project: redcap.Project
+    :param cache: optional RecordCache to keep the metadata in
+    :return: ProjectMetadata
+    :raises redcap.RedcapError: if the metadata could not be exported
+    """
+    started = datetime.datetime.now()
+    if cache is not None:
+        cached = cache.load_metadata(project)
+        if cached:
+            fields, cached_at = cached
+            changed = design_changed_since(project, cached_at)
+            if changed is False or (changed is None and started - cached_at < METADATA_MAX_AGE):
+                return ProjectMetadata(fields)
+
+    try:
+        fields = project.export_metadata()
+    except RequestException:
+        raise redcap.RedcapError('Exporting metadata failed. Check your URL and token.')
+    if not isinstance(fields, list) or not fields:
+        raise redcap.RedcapError('Exporting metadata failed. Check your URL and token.')
+    if cache is not None:
+        cache.store_metadata(project, fields, started)
+    return ProjectMetadata(fields)
+
+
+def connect(url, token, cache=None, **kwargs):
+    """
+    Connect to a REDCap project, loading its metadata once
+    :param url: REDCap API URL
+    :param token: REDCap API token of the project
+    :param cache: optional RecordCache to keep the metadata in
+    :param kwargs: timeout, retries, backoff and pool_size of the RedcapClient
+    :return: RedcapClient of the project and its ProjectMetadata
+    """
+    project = RedcapClient(url, token, lazy=True, **kwargs)
+    metadata = load_metadata(project, cache)
+    metadata.configure(project)
+    return project, metadata
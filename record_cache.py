@@ -0,0 +1,207 @@
+"""
+Local SQLite cache of exported REDCap records, kept up to date with incremental exports
+"""
+import contextlib
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+
+from report_pipeline import record_payload, stream_records
+
+REPORT_FIELDS = ['enrollment', 'grant', 'protocol', 'gender', 'ethnicity', 'race']
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.nih_report', 'cache.sqlite')
+
+# REDCap compares dateRangeBegin against server time, so ask for an overlap to allow for clock and time zone
+# differences. Records changed in the overlap are exported again and overwrite their cached copy.
+SYNC_OVERLAP = datetime.timedelta(days=1)
+REDCAP_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+QUERY_CHUNK_SIZE = 500  # Record ids per query, below SQLite's limit on query parameters
+WRITE_BATCH_SIZE = 5000  # Records written per transaction, so syncs of other projects can write in between
+BUSY_TIMEOUT = 60  # Seconds to wait for another connection's transaction to finish
+
+
+def export_records_since(project, fields, raw_or_label='label', since=None):
+    """
+    Export records, optionally only those created or modified since a given time
+    :param project: RedcapClient to export from
+    :param fields: fields to export, the record id field is always included
+    :param raw_or_label: 'raw' or 'label'
+    :param since: datetime.datetime for REDCap's dateRangeBegin, or None to export every record
+    :return: iterator over records, parsed as they download
+    """
+    payload = record_payload(project, fields, raw_or_label=raw_or_label)
+    if since:
+        payload['dateRangeBegin'] = since.strftime(REDCAP_TIME_FORMAT)
+    return stream_records(project, payload)
+
+
+class RecordCache:
+    """
+    Records exported from REDCap projects, stored in SQLite and keyed by API URL, project token and the fields and
+    format cached. Caches of different fields of the same project, such as the report's with and without a
+    participant field, share the database file without replacing each other's records.
+
+    The first sync of a project exports all of its records. Later syncs only export records changed since
+    the previous sync, plus the list of record ids so deleted records are dropped from the cache.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, fields=REPORT_FIELDS, raw_or_label='label', min_sync_interval=300):
+        """
+        :param path: SQLite database file, created if it does not exist
+        :param fields: fields to cache for each record
+        :param raw_or_label: whether to cache 'raw' codes or 'label's
+        :param min_sync_interval: seconds after a sync during which the cache is used without asking REDCap for
+            changes
+        """
+        self.path = path
+        self.fields = list(fields)
+        self.raw_or_label = raw_or_label
+        self.min_sync_interval = datetime.timedelta(seconds=min_sync_interval)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS sources '
+                         '(source TEXT PRIMARY KEY, settings TEXT NOT NULL, last_sync TEXT NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS records '
+                         '(source TEXT NOT NULL, row_key TEXT NOT NULL, record_id TEXT NOT NULL, data TEXT NOT NULL, '
+                         'PRIMARY KEY (source, row_key))')
+            conn.execute('CREATE INDEX IF NOT EXISTS records_id ON records (source, record_id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata '
+                         '(source TEXT PRIMARY KEY, cached_at TEXT NOT NULL, data TEXT NOT NULL)')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Open a connection to the cache, committed and closed on exit. Connections are not shared so the cache can
+        be used from any thread.
+        """
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _settings(self):
+        return json.dumps({'fields': self.fields, 'raw_or_label': self.raw_or_label})
+
+    @staticmethod
+    def source_key(project):
+        """
+        Key identifying a project in the cache. The token is hashed so it is not stored on disk.
+        :param project: redcap.Project
+        :return: key string
+        """
+        return project.url + '#' + hashlib.sha256(project.token.encode('utf-8')).hexdigest()
+
+    def _records_key(self, project):
+        # Records are kept apart for each set of fields and format, metadata is shared by every cache of a project
+        return self.source_key(project) + '#' + hashlib.sha256(self._settings().encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _row_key(project, record):
+        # Longitudinal projects export one row per record and event
+        return json.dumps([record[project.def_field], record.get('redcap_event_name', '')])
+
+    def sync(self, project, force=False):
+        """
+        Bring the cached records of a project up to date with REDCap
+        :param project: RedcapClient to sync
+        :param force: ask REDCap for changes even if the last sync was recent
+        :return: whether REDCap was asked for changes, False if the cached records were used as they are
+        """
+        source = self._records_key(project)
+        with self._connect() as conn:
+            row = conn.execute('SELECT last_sync FROM sources WHERE source = ?', (source,)).fetchone()
+        started = datetime.datetime.now()
+
+        since = None
+        if row:
+            last_sync = datetime.datetime.fromisoformat(row[0])
+            if not force and started - last_sync < self.min_sync_interval:
+                return False
+            since = last_sync - SYNC_OVERLAP
+
+        records = export_records_since(project, self.fields, self.raw_or_label, since)
+        if since:
+            current_ids = {r[project.def_field] for r in export_records_since(project, [project.def_field])}
+        else:
+            # Forget the last sync along with the records, so a full sync which fails part way is redone in full
+            with self._connect() as conn:
+                conn.execute('DELETE FROM sources WHERE source = ?', (source,))
+                conn.execute('DELETE FROM records WHERE source = ?', (source,))
+
+        # Records are written as they download, in batches so the database is not locked for the whole export
+        rows = ((source, self._row_key(project, r), r[project.def_field], json.dumps(r)) for r in records)
+        for batch in iter(lambda: list(itertools.islice(rows, WRITE_BATCH_SIZE)), []):
+            with self._connect() as conn:
+                conn.executemany('INSERT OR REPLACE INTO records (source, row_key, record_id, data) '
+                                 'VALUES (?, ?, ?, ?)', batch)
+
+        with self._connect() as conn:
+            if since:
+                cached_ids = {r[0] for r in conn.execute('SELECT DISTINCT record_id FROM records WHERE source = ?',
+                                                         (source,))}
+                conn.executemany('DELETE FROM records WHERE source = ? AND record_id = ?',
+                                 ((source, record_id) for record_id in cached_ids - current_ids))
+            conn.execute('INSERT OR REPLACE INTO sources (source, settings, last_sync) VALUES (?, ?, ?)',
+                         (source, self._settings(), started.isoformat()))
+        return True
+
+    def records(self, project, ids=None):
+        """
+        Cached records of a project
+        :param project: redcap.Project
+        :param ids: record ids to return, or None for all records
+        :return: iterator over record dicts
+        """
+        source = self._records_key(project)
+        with self._connect() as conn:
+            if ids is None:
+                rows = conn.execute('SELECT data FROM records WHERE source = ?', (source,))
+                for (data,) in rows:
+                    yield json.loads(data)
+                return
+            ids = list(ids)
+            for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[i:i + QUERY_CHUNK_SIZE]
+                rows = conn.execute('SELECT data FROM records WHERE source = ? AND record_id IN ({})'.format(
+                    ', '.join('?' * len(chunk))), [source] + chunk)
+                for (data,) in rows:
+                    yield json.loads(data)
+
+    def load_metadata(self, project):
+        """
+        Cached metadata of a project
+        :param project: redcap.Project
+        :return: (metadata, datetime.datetime it was exported) or None if it is not cached
+        """
+        with self._connect() as conn:
+            row = conn.execute('SELECT data, cached_at FROM metadata WHERE source = ?',
+                               (self.source_key(project),)).fetchone()
+        if row:
+            return json.loads(row[0]), datetime.datetime.fromisoformat(row[1])
+        return None
+
+    def store_metadata(self, project, metadata, exported_at):
+        """
+        Cache the metadata of a project
+        :param project: redcap.Project
+        :param metadata: metadata exported from REDCap
+        :param exported_at: datetime.datetime the metadata was exported
+        """
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO metadata (source, cached_at, data) VALUES (?, ?, ?)',
+                         (self.source_key(project), exported_at.isoformat(), json.dumps(metadata)))
+
+    def clear(self):
+        """
+        Remove all cached records and metadata
+        """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM records')
+            conn.execute('DELETE FROM sources')
+            conn.execute('DELETE FROM metadata')
@@ -0,0 +1,106 @@
+"""
+REDCap client owned by the app: a project whose requests share one pooled keep-alive session, ask for compressed
+responses, time out, and are retried when the server has a transient error
+"""
+import threading
+import time
+
+import redcap
+import requests
+from requests.adapters import HTTPAdapter
+from redcap.request import RCRequest
+
+POOL_SIZE = 4  # Connections kept open to the REDCap server, one per concurrent export request
+TIMEOUT = (10, 300)  # Seconds to wait for a connection, and for each read of a response
+RETRIES = 3  # Retries of a failed request before giving up
+BACKOFF = 1.0  # Seconds to wait before the first retry, doubled for each further retry
+RETRY_STATUSES = (500, 502, 503, 504)  # Server errors which are likely to pass
+
+
+def pooled_session(pool_size=POOL_SIZE):
+    """
+    Create a requests session which keeps up to pool_size connections to the REDCap server open, and asks for
+    gzip or deflate compressed responses
+    :param pool_size: number of connections to keep open
+    :return: requests.Session
+    """
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class RedcapClient(redcap.Project):
+    """
+    redcap.Project sending all of its API calls through a pooled session, with timeouts and retries
+    """
+
+    def __init__(self, url, token, name='', verify_ssl=True, lazy=False, timeout=TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, pool_size=POOL_SIZE):
+        """
+        :param url: REDCap API URL
+        :param token: REDCap API token of the project
+        :param name: name of the project
+        :param verify_ssl: verify the server's certificate, or path to a CA bundle to verify it with
+        :param lazy: don't export the project's metadata now
+        :param timeout: seconds to wait for a connection and for each read, as (connect, read) or for both
+        :param retries: number of retries of a failed request before its error is raised
+        :param backoff: seconds to wait before the first retry, doubled for each further retry
+        :param pool_size: number of connections to keep open
+        """
+        self.session = pooled_session(pool_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.bytes_received = 0  # Bytes of response bodies received over the network, compressed if they were
+        self._lock = threading.Lock()
+        super().__init__(url, token, name, verify_ssl, lazy)
+
+    def _kwargs(self):
+        return dict(super()._kwargs(), timeout=self.timeout)
+
+    def _call_api(self, payload, typpe, **kwargs):
+        request = RCRequest(self.url, payload, typpe, session=self.session)
+        response = self.post(request.payload, **kwargs)
+        request.raise_for_status(response)
+        content = request.get_content(response)
+        self.received(response)
+        return content, response.headers
+
+    def post(self, payload, **kwargs):
+        """
+        Send an API request, retrying with exponential backoff if the connection fails or the server answers with
+        one of RETRY_STATUSES
+        :param payload: request parameters
+        :param kwargs: passed on to requests.Session.post, e.g. stream=True
+        :return: requests.Response. Error statuses other than retried ones are returned for the caller to handle.
+        :raises requests.ConnectionError: if the last retry could not connect
+        """
+        kwargs = dict(self._kwargs(), **kwargs)
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data=payload, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                response.close()
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def received(self, response):
+        """
+        Add the body of a response which has been read to bytes_received
+        :param response: requests.Response
+        """
+        with self._lock:
+            self.bytes_received += response.raw.tell()
+
+    def close(self):
+        """
+        Close the connections kept open to the REDCap server
+        """
+        self.session.close()
@@ -2,13 +2,39 @@
 """
 Application to generate NIH demographic reports from REDCap data via the REDCap API. Report is displayed in app
 with the option to export to CSV.
+
+Run with --startup-timing to report how long the imports and showing the first window take.
 """
+import time
+
+LAUNCHED = time.perf_counter()  # Taken before the imports below so --startup-timing includes them
+
+import argparse
+import os
+import sqlite3
+import sys
+import threading
+
 import wx
 
 from api_key_frame import APIKeyFrame
-from report_window import ReportWindow
 
 USE_DATEPICKCTRL = 1  # Needed to access date picker widget
+STARTUP_LOG = os.path.expanduser(os.path.join('~', '.nih_report', 'startup.log'))
+
+
+def log_startup(stage):
+    """
+    Report the time since launch at a startup stage, to stderr or to STARTUP_LOG if there is no console
+    :param stage: name of the stage reached
+    """
+    line = '{:<24}{:>8.3f}s'.format(stage, time.perf_counter() - LAUNCHED)
+    if sys.stderr:
+        print(line, file=sys.stderr)
+    else:
+        os.makedirs(os.path.dirname(STARTUP_LOG), exist_ok=True)
+        with open(STARTUP_LOG, 'a') as log:
+            print(line, file=log)
 
 
 class ReportFrame(wx.Frame):
@@ -16,29 +42,153 @@ class ReportFrame(wx.Frame):
     Report app main frame
     """
 
-    def __init__(self):
+    def __init__(self, startup_timing=False):
+        """
+        :param startup_timing: report how long each stage of startup takes
+        """
         super().__init__(parent=None, title='NIH Report')
-        self.project = None
+        self.startup_timing = startup_timing
+        self.sources = []  # (RedcapClient, ProjectMetadata) of each connected project
+        self.participant_field = None  # Field identifying a participant across projects, if given
+        self.cache = None  # RecordCache, or None if reports are exported directly from REDCap without a cache
+        self.report_window = None  # Created once the report modules are imported
+        self.report_window_callbacks = []  # Called once the report window is created
 
-        APIKeyFrame(parent=self)
+        key_frame = APIKeyFrame(parent=self)
+        if startup_timing:
+            key_frame.panel.Bind(wx.EVT_PAINT, self.on_key_window_painted)
 
         self.sizer = wx.BoxSizer(wx.VERTICAL)
-        self.report_window = ReportWindow(self)
-        self.sizer.Add(self.report_window, 1, wx.EXPAND)
 
         menubar = wx.MenuBar()
         file_menu = wx.Menu()
         self.menuExport = file_menu.Append(wx.ID_SAVEAS, 'Export .csv', 'Export .csv report')
         self.menuExport.Enable(enable=False)
+        self.menu_clear_cache = file_menu.Append(wx.ID_ANY, 'Clear Cached Records',
+                                                 'Export all records from REDCap on the next update')
+        self.menu_clear_cache.Enable(enable=False)
         menubar.Append(file_menu, '&File')
+        debug_menu = wx.Menu()
+        menu_timings = debug_menu.Append(wx.ID_ANY, 'Show Update Timings...',
+                                         'Show the time, records and bytes of each stage of the last update')
+        self.menu_profile = debug_menu.AppendCheckItem(wx.ID_ANY, 'Profile Updates',
+                                                       'Dump a cProfile profile of each update')
+        menubar.Append(debug_menu, '&Debug')
         self.SetMenuBar(menubar)
 
-        self.Bind(wx.EVT_MENU, self.report_window.on_export, self.menuExport)
+        self.Bind(wx.EVT_MENU, self.on_clear_cache, self.menu_clear_cache)
+        self.Bind(wx.EVT_MENU, self.on_show_timings, menu_timings)
 
         self.SetSizer(self.sizer)
+        threading.Thread(target=self.import_report_modules, daemon=True).start()
 
+    def on_key_window_painted(self, evt):
+        """
+        Log when the API key window is first painted
+        :param evt: paint event of the window's panel
+        """
+        evt.Skip()
+        evt.GetEventObject().Unbind(wx.EVT_PAINT, handler=self.on_key_window_painted)
+        log_startup('API key window painted')
+
+    def import_report_modules(self):
+        """
+        Import the report modules on a background thread, so the API key window is shown and responds while they
+        load, then build the report window on the GUI thread
+        """
+        try:
+            import record_cache
+            import report_window
+            if self.startup_timing:
+                log_startup('report modules imported')
+        finally:
+            # A failed import is raised again on the GUI thread by load_report_window
+            wx.CallAfter(self.load_report_window)
+
+    def load_report_window(self):
+        """
+        Build the report window once the report modules are imported, and run the callbacks waiting on it
+        """
+        if not self:
+            return  # Closed from the API key window while the modules were loading
+        from record_cache import RecordCache
+        from report_window import ReportWindow
+
+        try:
+            self.cache = RecordCache(raw_or_label='raw')
+        except (OSError, sqlite3.Error):
+            self.cache = None
+        self.menu_clear_cache.Enable(enable=self.cache is not None)
+
+        self.report_window = ReportWindow(self)
+        self.sizer.Add(self.report_window, 1, wx.EXPAND)
+        self.Bind(wx.EVT_MENU, self.report_window.on_export, self.menuExport)
+        if self.startup_timing:
+            log_startup('report window')
+        for callback in self.report_window_callbacks:
+            callback()
+        self.report_window_callbacks = []
+
+    def when_report_window_ready(self, callback):
+        """
+        Call a function once the report window is created, right away if it already is
+        :param callback: function taking no arguments
+        """
+        if self.report_window is None:
+            self.report_window_callbacks.append(callback)
+        else:
+            callback()
+
+    def use_participant_field(self, field):
+        """
+        Set the field identifying a participant across projects, caching it along with the report fields
+        :param field: name of the field, or None to count every record
+        """
+        self.participant_field = field
+        if field and self.cache is not None:
+            from record_cache import REPORT_FIELDS, RecordCache
+            try:
+                self.cache = RecordCache(self.cache.path, REPORT_FIELDS + [field], raw_or_label='raw')
+            except (OSError, sqlite3.Error):
+                self.cache = None
+            self.menu_clear_cache.Enable(enable=self.cache is not None)
+
+    def on_show_timings(self, evt):
+        """
+        Show the timings of the last update
+        :param evt: event which triggered the dialog
+        """
+        if self.report_window:
+            self.report_window.show_timings()
+
+    def on_clear_cache(self, evt):
+        """
+        Remove all cached records
+        :param evt: event which triggered the clear
+        """
+        try:
+            self.cache.clear()
+        except sqlite3.Error as e:
+            self.report_window.show_error("Can't clear cache: {}".format(e))
+
+
+def main(argv=None):
+    """
+    Run the application
+    :param argv: arguments to parse, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(prog='report_app', description='NIH demographic reports from REDCap.')
+    parser.add_argument('--startup-timing', action='store_true',
+                        help='report how long the imports and showing the windows take, to stderr or {}'.format(
+                            STARTUP_LOG))
+    args, _ = parser.parse_known_args(argv)  # Ignore arguments added by the OS, such as macOS's -psn_*
 
-if __name__ == '__main__':
     app = wx.App(True)
-    report_frame = ReportFrame()
+    if args.startup_timing:
+        log_startup('app created')
+    ReportFrame(startup_timing=args.startup_timing)
     app.MainLoop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Command line entry point to generate NIH demographic reports from REDCap without the GUI.
+
+Run with `python -m report_cli --help`. The API token is read from the REDCAP_API_TOKEN environment
+variable if --token is not given. Repeat --token to report on several projects together, and pass
+--participant-field to count participants enrolled in more than one of them once. With --period, one table is
+written per month or quarter of the date range. --extract also writes the matching participants to a csv, Parquet,
+Feather or Excel file.
+"""
+import argparse
+import datetime
+import os
+import sys
+
+import redcap
+
+from instrumentation import Timings, profiled
+from multi_project import combined_choices, connect_all, run_combined_periods, run_combined_report
+from period_counts import PERIODS
+from record_cache import DEFAULT_PATH, REPORT_FIELDS, RecordCache
+from redcap_client import TIMEOUT
+from report_export import FORMATS, export_report, extract_batches
+from report_pipeline import write_report, write_trend_report
+
+DEFAULT_URL = 'https://redcap.ahc.umn.edu/api/'
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments
+    :param argv: arguments to parse, defaults to sys.argv
+    :return: parsed arguments
+    """
+    parser = argparse.ArgumentParser(prog='python -m report_cli',
+                                     description='Write the NIH cumulative enrollment report for a REDCap '
+                                                 'project to csv.')
+    parser.add_argument('--url', default=DEFAULT_URL, help='REDCap API URL (default: %(default)s)')
+    parser.add_argument('--token', action='append', dest='tokens', metavar='TOKEN',
+                        help='REDCap API token, may be repeated to combine projects (default: $REDCAP_API_TOKEN)')
+    parser.add_argument('--participant-field', metavar='FIELD',
+                        help='field identifying a participant across projects, to count each participant once')
+    parser.add_argument('--grant', action='append', dest='grants', metavar='GRANT',
+                        help='grant label to include, may be repeated (default: all grants)')
+    parser.add_argument('--protocol', action='append', dest='protocols', metavar='PROTOCOL',
+                        help='protocol label to include, may be repeated (default: all protocols)')
+    parser.add_argument('--start', type=datetime.date.fromisoformat, required=True,
+                        help='first enrollment date to include, YYYY-MM-DD')
+    parser.add_argument('--end', type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help='last enrollment date to include, YYYY-MM-DD (default: today)')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT[1], metavar='SECONDS',
+                        help='seconds to wait for each read of a REDCap response (default: %(default)s)')
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_PATH, metavar='PATH',
+                        help='keep exported records in a local cache and only export changed records from REDCap '
+                             '(default path: %(const)s)')
+    parser.add_argument('--period', choices=PERIODS,
+                        help='write one table per month or quarter of the date range instead of one for all of it')
+    parser.add_argument('--cumulative', action='store_true',
+                        help='with --period, count from the start date to the end of each period')
+    parser.add_argument('-o', '--output', default='-', help='csv file to write (default: stdout)')
+    parser.add_argument('--extract', metavar='FILE',
+                        help='also write the participants of the report and its summary to FILE, as {} by its '
+                             'extension'.format(', '.join(FORMATS)))
+    parser.add_argument('--timings', action='store_true',
+                        help='print the time, records and bytes of each stage of the report to stderr')
+    parser.add_argument('--profile', metavar='FILE', help='dump a cProfile profile of the report to FILE')
+    args = parser.parse_args(argv)
+    if not args.tokens:
+        args.tokens = [os.environ['REDCAP_API_TOKEN']] if os.environ.get('REDCAP_API_TOKEN') else []
+    if not args.tokens:
+        parser.error('an API token is required, pass --token or set REDCAP_API_TOKEN')
+    if args.start > args.end:
+        parser.error('start date must be earlier than end date')
+    if args.cumulative and not args.period:
+        parser.error('--cumulative needs --period')
+    if args.extract and os.path.splitext(args.extract)[1].lower() not in FORMATS:
+        parser.error('--extract must be a {} file'.format(', '.join(FORMATS)))
+    return args
+
+
+def select_codes(choices, labels):
+    """
+    Look up the codes of the chosen labels
+    :param choices: dict of choice code to label
+    :param labels: labels to look up, or None for all choices
+    :return: list of (code, label) pairs
+    :raises ValueError: if a label is not one of the choices
+    """
+    if not labels:
+        return list(choices.items())
+    codes = {label: code for code, label in choices.items()}
+    try:
+        return [(codes[label], label) for label in labels]
+    except KeyError as e:
+        raise ValueError('{} is not one of: {}'.format(e, ', '.join(choices.values())))
+
+
+def fetch_report(args, timings):
+    """
+    Connect to every project given and count the participants matching the command line options across them,
+    printing each project's total to stderr if there are several, and write the participant extract if asked for
+    :param args: parsed arguments
+    :param timings: Timings to add the stages of the report to
+    :return: merged CountTable of the participants, or the periods of the report from PeriodCounts.periods with
+        --period, and the (label, label) pairs of the selected grants and protocols
+    """
+    fields = REPORT_FIELDS + [args.participant_field] if args.participant_field else REPORT_FIELDS
+    cache = RecordCache(args.cache, fields, raw_or_label='raw', min_sync_interval=0) if args.cache else None
+    with timings.stage('metadata'):
+        sources = connect_all(args.url, args.tokens, cache, timeout=(TIMEOUT[0], args.timeout))
+    grant_labels = combined_choices(sources, 'grant')
+    protocol_labels = combined_choices(sources, 'protocol')
+    grants = select_codes(dict(zip(grant_labels, grant_labels)), args.grants)
+    protocols = select_codes(dict(zip(protocol_labels, protocol_labels)), args.protocols)
+    grant_sel = [label for label, _ in grants]
+    protocol_sel = [label for label, _ in protocols]
+    if args.period:
+        merged, projects, indexes = run_combined_periods(sources, grant_sel, protocol_sel, args.participant_field,
+                                                         cache, timings=timings)
+        counts = merged.between(args.start, args.end)
+        project_counts = [project.between(args.start, args.end) for project in projects]
+    else:
+        counts, project_counts, indexes = run_combined_report(sources, grant_sel, protocol_sel, args.start, args.end,
+                                                              args.participant_field, cache, timings=timings)
+    if args.extract:
+        with timings.stage('participant extract') as stage:
+            stage.records = export_report(args.extract, counts, grant_sel, protocol_sel,
+                                          extract_batches(sources, grant_sel, protocol_sel, args.start, args.end,
+                                                          args.participant_field, cache, indexes),
+                                          args.participant_field)
+        print('wrote {} participants to {}'.format(stage.records, args.extract), file=sys.stderr)
+    if len(sources) > 1:
+        for i, project_total in enumerate(project_counts):
+            print('project {}: {} participants'.format(i + 1, project_total.total), file=sys.stderr)
+        print('combined: {} participants'.format(counts.total), file=sys.stderr)
+    if args.period:
+        return merged.periods(args.start, args.end, args.period), grants, protocols
+    return counts, grants, protocols
+
+
+def write_output(file, args, counts, grants, protocols):
+    """
+    Write the report, or one table per period with --period
+    :param file: file to write to
+    :param args: parsed arguments
+    :param counts: CountTable, or the periods of the report from PeriodCounts.periods
+    :param grants: selected grant labels
+    :param protocols: selected protocol labels
+    """
+    if args.period:
+        write_trend_report(file, counts, grants, protocols, args.cumulative)
+    else:
+        write_report(file, counts, grants, protocols)
+
+
+def main(argv=None):
+    """
+    Run a report from the command line
+    :param argv: arguments to parse, defaults to sys.argv
+    :return: exit status
+    """
+    args = parse_args(argv)
+    timings = Timings()
+    try:
+        if args.profile:
+            counts, grants, protocols = profiled(args.profile, fetch_report, args, timings)
+        else:
+            counts, grants, protocols = fetch_report(args, timings)
+    except (redcap.RedcapError, ValueError, ImportError, IOError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        return 1
+
+    grants = [label for _, label in grants]
+    protocols = [label for _, label in protocols]
+
+    with timings.stage('write report'):
+        if args.output == '-':
+            write_output(sys.stdout, args, counts, grants, protocols)
+        else:
+            try:
+                with open(args.output, 'w', newline='') as file:
+                    write_output(file, args, counts, grants, protocols)
+            except IOError as e:
+                print("Can't save file: {}".format(e), file=sys.stderr)
+                return 1
+    if args.timings:
+        print(timings.report(), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,259 @@
+"""
+Export of a report's summary table and participant-level extract to csv, Parquet, Feather or Excel files, written
+in batches so large extracts are never held in memory. pyarrow (Parquet and Feather) and xlsxwriter (Excel) are
+optional and only imported when a file of their format is written.
+"""
+import csv
+import datetime
+import itertools
+import os
+
+import numpy as np
+
+from multi_project import enrolled, selected_records
+from record_cache import REPORT_FIELDS
+from report_pipeline import report_rows, write_report
+from tabulation import ETHNICITIES, GENDERS, RACES, demographic_codes
+
+EXPORT_BATCH_SIZE = 50000  # Participants read, converted and written at a time
+FORMATS = {'.xlsx': 'Excel workbook', '.parquet': 'Parquet', '.feather': 'Feather', '.csv': 'CSV'}
+XLSX_MAX_ROWS = 1048576  # Rows of an Excel worksheet, including the header
+EPOCH = datetime.date(1970, 1, 1).toordinal()  # Arrow dates count days from 1970-01-01
+CATEGORIES = {'race': RACES, 'ethnicity': ETHNICITIES, 'gender': GENDERS}
+
+
+def extract_columns(key_field=None):
+    """
+    Column names of the participant extract
+    :param key_field: field identifying a participant across projects, or None
+    :return: list of column names
+    """
+    key = [key_field] if key_field else []
+    return ['project', 'record_id'] + key + ['enrollment', 'grant', 'protocol', 'race', 'ethnicity', 'gender']
+
+
+def extract_batches(sources, grant_sel, protocol_sel, start, end, key_field=None, cache=None, indexes=None,
+                    progress=None):
+    """
+    Export the records matching the selection from each project in turn, converted to columns in batches
+    :param sources: list of (RedcapClient, ProjectMetadata)
+    :param grant_sel: labels of the grants to include
+    :param protocol_sel: labels of the protocols to include
+    :param start: first enrollment date to include
+    :param end: last enrollment date to include
+    :param key_field: optional field identifying a participant across projects, added as a column
+    :param cache: optional RecordCache of raw codes to export from, see multi_project.selected_records
+    :param indexes: EnrollmentIndex per source from an earlier report, or None
+    :param progress: optional function called with a message
+    :return: iterator over dicts of column name to the values of up to EXPORT_BATCH_SIZE participants. Enrollment
+        dates are day ordinals, and race, ethnicity and gender are positions in RACES, ETHNICITIES and GENDERS,
+        -1 where the value matched no category.
+    """
+    indexes = indexes or [None] * len(sources)
+    for i, (project, metadata) in enumerate(sources):
+        if progress:
+            progress('Exporting participants (project {} of {})'.format(i + 1, len(sources)))
+        records, _ = selected_records(project, metadata, grant_sel, protocol_sel, start, end, key_field, cache,
+                                      indexes[i], fields=REPORT_FIELDS)
+        grants = metadata.choices('grant')
+        protocols = metadata.choices('protocol')
+        lookups = metadata.demographic_lookups()
+        # Rows of events without the enrollment are left out, as they are from the report's counts
+        records = enrolled(records)
+        for rows in iter(lambda: list(itertools.islice(records, EXPORT_BATCH_SIZE)), []):
+            batch = [r for _, r in rows]
+            race, ethnicity, gender = demographic_codes(batch, lookups)
+            columns = {'project': np.full(len(batch), i + 1, dtype=np.int32),
+                       'record_id': [r[project.def_field] for r in batch]}
+            if key_field:
+                columns[key_field] = [r.get(key_field, '').strip() or None for r in batch]
+            columns.update({'enrollment': np.array([enrollment for enrollment, _ in rows], dtype=np.int64),
+                            'grant': [grants.get(r['grant'], r['grant']) for r in batch],
+                            'protocol': [protocols.get(r['protocol'], r['protocol']) for r in batch],
+                            'race': race, 'ethnicity': ethnicity, 'gender': gender})
+            yield columns
+
+
+def extract_rows(columns):
+    """
+    Rows of a batch of the extract, with dates and category labels for csv and Excel
+    :param columns: dict of column name to values, as from extract_batches
+    :return: iterator over rows, in the order of the columns
+    """
+    values = []
+    for name, column in columns.items():
+        if name == 'enrollment':
+            values.append([datetime.date.fromordinal(day) for day in column.tolist()])
+        elif name in CATEGORIES:
+            values.append([CATEGORIES[name][code] if code >= 0 else None for code in column.tolist()])
+        else:
+            values.append(column.tolist() if isinstance(column, np.ndarray) else column)
+    return zip(*values)
+
+
+def summary_rows(counts):
+    """
+    Counts of the summary table in long form, one row per race/ethnicity/gender cell, for tabular formats
+    :param counts: CountTable to export
+    :return: list of (race, ethnicity, gender, count) rows, with a last row of None categories counting the
+        participants whose demographics matched no category
+    """
+    rows = [(race, ethnicity, gender, counts.count(r, e, g))
+            for r, race in enumerate(RACES) for e, ethnicity in enumerate(ETHNICITIES)
+            for g, gender in enumerate(GENDERS)]
+    rows.append((None, None, None, counts.total - int(counts.cube.sum())))
+    return rows
+
+
+def summary_path(path):
+    """
+    File next to an extract holding the summary table, for formats with one table per file
+    :param path: file of the extract
+    :return: path with _summary added before the extension
+    """
+    stem, extension = os.path.splitext(path)
+    return stem + '_summary' + extension
+
+
+def write_csv(path, counts, grant_sel, protocol_sel, batches, columns):
+    """
+    Write the extract to a csv file and the summary report to a csv file next to it
+    :return: number of participants written
+    """
+    with open(summary_path(path), 'w', newline='') as file:
+        write_report(file, counts, grant_sel, protocol_sel)
+    written = 0
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(extract_rows(batch))
+            written += len(batch['record_id'])
+    return written
+
+
+def write_xlsx(path, counts, grant_sel, protocol_sel, batches, columns):
+    """
+    Write an Excel workbook with a Summary sheet of the report and Participants sheets of the extract. Rows are
+    flushed to disk as they are written, and the extract goes on to further sheets past Excel's row limit.
+    :return: number of participants written
+    """
+    try:
+        import xlsxwriter
+    except ImportError:
+        raise ImportError('Writing .xlsx files needs xlsxwriter, install it with `pip install xlsxwriter`')
+
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    try:
+        summary = workbook.add_worksheet('Summary')
+        for row, values in enumerate(report_rows(counts, grant_sel, protocol_sel)):
+            summary.write_row(row, 0, values)
+
+        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        enrollment = columns.index('enrollment')
+        sheet = None
+        row = XLSX_MAX_ROWS
+        written = 0
+        for batch in batches:
+            for values in extract_rows(batch):
+                if row == XLSX_MAX_ROWS:
+                    sheet = workbook.add_worksheet('Participants' if sheet is None else
+                                                   'Participants {}'.format(len(workbook.worksheets())))
+                    sheet.set_column(enrollment, enrollment, 12, date_format)
+                    sheet.write_row(0, 0, columns)
+                    row = 1
+                sheet.write_row(row, 0, values)
+                row += 1
+            written += len(batch['record_id'])
+        if sheet is None:
+            workbook.add_worksheet('Participants').write_row(0, 0, columns)
+    finally:
+        workbook.close()
+    return written
+
+
+def arrow_batch(pa, columns, schema):
+    """
+    Convert a batch of the extract to an Arrow record batch. Categories are dictionary encoded against the fixed
+    lists of categories, so every batch shares the same dictionaries.
+    :param pa: the pyarrow module
+    :param columns: dict of column name to values, as from extract_batches
+    :param schema: pyarrow.Schema of the extract
+    :return: pyarrow.RecordBatch
+    """
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if field.name == 'enrollment':
+            arrays.append(pa.array(values - EPOCH, type=pa.int32()).cast(pa.date32()))
+        elif field.name in CATEGORIES:
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(values, mask=values < 0, type=pa.int8()),
+                                                         pa.array(CATEGORIES[field.name])))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def write_arrow(path, counts, grant_sel, protocol_sel, batches, columns, parquet):
+    """
+    Write the extract to a zstd compressed Parquet or Feather file, one row group or record batch per batch, and
+    the summary table to a file of the same format next to it
+    :param parquet: write Parquet rather than Feather
+    :return: number of participants written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Writing .parquet and .feather files needs pyarrow, install it with `pip install pyarrow`')
+
+    # The grants and protocols of the report are kept in the schema metadata of both files
+    metadata = {'grants': '\n'.join(grant_sel), 'protocols': '\n'.join(protocol_sel)}
+    types = {'project': pa.int32(), 'enrollment': pa.date32()}
+    types.update({name: pa.dictionary(pa.int8(), pa.string()) for name in CATEGORIES})
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in columns], metadata=metadata)
+    summary = pa.Table.from_arrays([pa.array(column) for column in zip(*summary_rows(counts))],
+                                   schema=pa.schema([('race', pa.string()), ('ethnicity', pa.string()),
+                                                     ('gender', pa.string()), ('count', pa.int64())],
+                                                    metadata=metadata))
+
+    written = 0
+    if parquet:
+        pyarrow.parquet.write_table(summary, summary_path(path))
+        with pyarrow.parquet.ParquetWriter(path, schema, compression='zstd') as writer:
+            for batch in batches:
+                writer.write_batch(arrow_batch(pa, batch, schema))
+                written += len(batch['record_id'])
+    else:
+        pyarrow.feather.write_feather(summary, summary_path(path), compression='zstd')
+        options = pa.ipc.IpcWriteOptions(compression='zstd')
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+            for batch in batches:
+                writer.write_batch(arrow_batch(pa, batch, schema))
+                written += len(batch['record_id'])
+    return written
+
+
+def export_report(path, counts, grant_sel, protocol_sel, batches, key_field=None):
+    """
+    Write a report's summary table and participant extract, in the format given by the file extension
+    :param path: file to write. Csv, Parquet and Feather extracts get their summary in a _summary file next to it.
+    :param counts: CountTable of the report
+    :param grant_sel: grant labels the report was run for
+    :param protocol_sel: protocol labels the report was run for
+    :param batches: batches of the extract, as from extract_batches
+    :param key_field: field identifying a participant across projects, if extract_batches was given one
+    :return: number of participants written
+    :raises ValueError: if the extension is not one of FORMATS
+    :raises ImportError: if the optional package writing the format is not installed
+    """
+    extension = os.path.splitext(path)[1].lower()
+    columns = extract_columns(key_field)
+    if extension == '.csv':
+        return write_csv(path, counts, grant_sel, protocol_sel, batches, columns)
+    if extension == '.xlsx':
+        return write_xlsx(path, counts, grant_sel, protocol_sel, batches, columns)
+    if extension in ('.parquet', '.feather'):
+        return write_arrow(path, counts, grant_sel, protocol_sel, batches, columns, extension == '.parquet')
+    raise ValueError('Unknown export format {}, use one of {}'.format(extension or path, ', '.join(FORMATS)))
@@ -0,0 +1,234 @@
+"""
+Fetching, filtering and writing of the NIH demographics report, independent of the GUI
+"""
+import csv
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from redcap.request import RedcapError
+
+from instrumentation import profiled_task
+from tabulation import RACES, ETHNICITIES, GENDERS
+
+DEMOGRAPHIC_FIELDS = ['gender', 'ethnicity', 'race']
+
+CHUNK_SIZE = 500  # Record ids per demographics export request
+MAX_WORKERS = 4  # Concurrent demographics export requests
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes read at a time from a streamed export
+
+
+def record_payload(project, fields, records=None, raw_or_label='label'):
+    """
+    Build the payload of a REDCap record export
+    :param project: redcap.Project to export from
+    :param fields: fields to export, the record id field is always included
+    :param records: record ids to export, or None for all records
+    :param raw_or_label: 'raw' or 'label'
+    :return: payload dict
+    """
+    payload = {'token': project.token, 'content': 'record', 'format': 'json', 'type': 'flat',
+               'rawOrLabel': raw_or_label}
+    for i, field in enumerate([project.def_field] + [f for f in fields if f != project.def_field]):
+        payload['fields[{}]'.format(i)] = field
+    for i, record in enumerate(records or []):
+        payload['records[{}]'.format(i)] = record
+    return payload
+
+
+def csv_lines(chunks):
+    """
+    Split streamed text into lines for the csv module, keeping line endings so quoted values spanning lines
+    are parsed whole
+    :param chunks: iterable of text chunks
+    :return: iterator over lines
+    """
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def stream_records(project, payload):
+    """
+    Send a record export in csv format and parse the response while it downloads, so records can be processed
+    without holding the whole export in memory
+    :param project: RedcapClient to export from
+    :param payload: record export payload, e.g. from record_payload
+    :return: iterator over record dicts
+    :raises RedcapError: if REDCap answers with an error
+    """
+    with project.post(dict(payload, format='csv', returnFormat='json'), stream=True) as response:
+        if response.status_code >= 400:
+            raise RedcapError(response.text)
+        response.encoding = 'utf-8-sig'
+        yield from csv.DictReader(csv_lines(response.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True)))
+        project.received(response)
+
+
+def export_chunk(project, ids, fields, raw_or_label='label'):
+    """
+    Export the given fields of a chunk of records
+    :param project: redcap.Project to export from. A RedcapClient retries the request on transient errors.
+    :param ids: record ids to export
+    :param fields: fields to export
+    :param raw_or_label: 'raw' or 'label'
+    :return: list of records
+    """
+    return project._call_api(record_payload(project, fields, ids, raw_or_label), 'exp_record')[0]
+
+
+def export_chunks(project, ids, fields=DEMOGRAPHIC_FIELDS, raw_or_label='label', chunk_size=CHUNK_SIZE,
+                  max_workers=MAX_WORKERS, progress=None):
+    """
+    Export the given fields of records in chunks, sent concurrently over the project's connections
+    :param project: redcap.Project to export from
+    :param ids: record ids to export
+    :param fields: fields to export
+    :param raw_or_label: 'raw' or 'label'
+    :param chunk_size: record ids per request
+    :param max_workers: maximum number of concurrent requests
+    :param progress: optional function called with the number of chunks done and the total number of chunks.
+        Chunks which have not been sent yet are skipped if it raises.
+    :return: iterator over the list of records of each chunk, in the order of the chunks of ids
+    """
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    stop = threading.Event()
+
+    def export(chunk):
+        if stop.is_set():
+            return []
+        return export_chunk(project, chunk, fields, raw_or_label)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for done, records in enumerate(executor.map(profiled_task(export), chunks), 1):
+                yield records
+                if progress:
+                    progress(done, len(chunks))
+        except BaseException:
+            stop.set()
+            raise
+
+
+def build_filter_logic(grant_codes, protocol_codes, start, end):
+    """
+    Build REDCap filter logic matching enrollments for the given grants and protocols within a date range
+    :param grant_codes: raw grant choice codes to include
+    :param protocol_codes: raw protocol choice codes to include
+    :param start: first enrollment date to include, or None for every enrollment
+    :param end: last enrollment date to include, or None for every enrollment
+    :return: filterLogic string for the REDCap API
+    """
+    grants = ' or '.join("[grant] = '{}'".format(code) for code in grant_codes)
+    protocols = ' or '.join("[protocol] = '{}'".format(code) for code in protocol_codes)
+    if start is None or end is None:
+        return "({}) and ({}) and [enrollment] <> ''".format(grants, protocols)
+    # Compare against the day after the end date so enrollment datetimes on the end date are included
+    return "({}) and ({}) and [enrollment] >= '{}' and [enrollment] < '{}'".format(
+        grants, protocols, start.isoformat(), (end + datetime.timedelta(days=1)).isoformat())
+
+
+def export_enrollments(project, grant_codes, protocol_codes, start, end, ids_only=True):
+    """
+    Export the enrollments matching the selection, filtered by REDCap before they are sent
+    :param project: redcap.Project to export from
+    :param grant_codes: raw grant choice codes to include
+    :param protocol_codes: raw protocol choice codes to include
+    :param start: first enrollment date to include, or None for every enrollment
+    :param end: last enrollment date to include, or None for every enrollment
+    :param ids_only: only export the record id of each enrollment
+    :return: iterator over enrollment records, with raw grant and protocol codes, parsed as they download
+    """
+    if not grant_codes or not protocol_codes:
+        return iter([])
+    fields = [project.def_field] if ids_only else ['enrollment', 'grant', 'protocol']
+    payload = record_payload(project, fields, raw_or_label='raw')
+    payload['filterLogic'] = build_filter_logic(grant_codes, protocol_codes, start, end)
+    return stream_records(project, payload)
+
+
+def export_enrollment_ids(project, grant_codes, protocol_codes, start, end):
+    """
+    Export the record ids of the enrollments matching the selection
+    :param project: redcap.Project to export from
+    :param grant_codes: raw grant choice codes to include
+    :param protocol_codes: raw protocol choice codes to include
+    :param start: first enrollment date to include, or None for every enrollment
+    :param end: last enrollment date to include, or None for every enrollment
+    :return: list of record ids, without duplicates
+    """
+    enrollments = export_enrollments(project, grant_codes, protocol_codes, start, end)
+    return list(dict.fromkeys(e[project.def_field] for e in enrollments))
+
+
+def report_rows(counts, grant_sel, protocol_sel):
+    """
+    Rows of the csv report
+    :param counts: CountTable to report
+    :param grant_sel: grant labels the report was run for
+    :param protocol_sel: protocol labels the report was run for
+    :return: iterator over rows
+    """
+    # Headers
+    yield ['Grants:'] + list(grant_sel)
+    yield ['Protocols:'] + list(protocol_sel)
+    row = ['']
+    for eth in range(len(ETHNICITIES)):
+        for gen in range(len(GENDERS)):
+            row.append(ETHNICITIES[eth] + '/' + GENDERS[gen])
+    yield row
+
+    # Table and row sums
+    race_totals = counts.race_totals
+    for race in range(len(RACES)):
+        row = [RACES[race]]
+        for eth in range(len(ETHNICITIES)):
+            for gen in range(len(GENDERS)):
+                row.append(counts.count(race, eth, gen))
+        row.append(int(race_totals[race]))
+        yield row
+
+    # Column sums
+    row = ['Totals by Gender and Ethnicity']
+    column_totals = counts.column_totals
+    for eth in range(len(ETHNICITIES)):
+        for gen in range(len(GENDERS)):
+            row.append(int(column_totals[eth, gen]))
+    row.append(counts.total)
+    row.append('<- Total enrollments')
+    yield row
+
+
+def write_report(file, counts, grant_sel, protocol_sel):
+    """
+    Write demographic measures to file in csv format, streaming rows from the count table.
+    :param file: file to write to
+    :param counts: CountTable to write
+    :param grant_sel: grant labels the report was run for
+    :param protocol_sel: protocol labels the report was run for
+    """
+    report_writer = csv.writer(file, delimiter=',',
+                               quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    report_writer.writerows(report_rows(counts, grant_sel, protocol_sel))
+
+
+def write_trend_report(file, periods, grant_sel, protocol_sel, cumulative=False):
+    """
+    Write the demographic measures of each month or quarter to file in csv format, one table after another
+    :param file: file to write to
+    :param periods: list of (label, first date, last date, CountTable of the period, cumulative CountTable) as from
+        PeriodCounts.periods
+    :param grant_sel: grant labels the report was run for
+    :param protocol_sel: protocol labels the report was run for
+    :param cumulative: write the counts from the start of the report to the end of each period instead
+    """
+    report_writer = csv.writer(file, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    for label, first, last, counts, to_date in periods:
+        report_writer.writerow(['Period:', label, first.isoformat(), last.isoformat()])
+        report_writer.writerows(report_rows(to_date if cumulative else counts, grant_sel, protocol_sel))
+        report_writer.writerow([])
@@ -1,16 +1,89 @@
 """
 Window to display input options and output measures for NIH demographics report
 """
-import csv
+import datetime
+import os
 
 import wx
 import wx.adv
 
+import multi_project
+import report_export
+import report_pipeline
+from instrumentation import Timings, profiled
+from period_counts import PERIODS
+from record_cache import DEFAULT_PATH
+from tabulation import RACES, ETHNICITIES, GENDERS
+from worker import Worker, EVT_WORKER_DONE, EVT_WORKER_PROGRESS
 
-RACES = ['American Indian/Alaska Native', 'Asian', 'Native Hawaiian or Other Pacific Islander',
-         'Black or African American', 'White', 'More Than One Race', 'Unknown']
-ETHNICITIES = ['Not Hispanic or Latino', 'Hispanic or Latino', 'Unknown']
-GENDERS = ['Female', 'Male', 'Unknown']
+PROFILE_DIR = os.path.dirname(DEFAULT_PATH)  # Where profiles of updates are dumped when profiling is on
+
+
+def to_date(value):
+    """
+    Convert a wx.DateTime to a datetime.date
+    :param value: wx.DateTime to convert
+    :return: datetime.date of the same day
+    """
+    return datetime.date(value.GetYear(), value.GetMonth() + 1, value.GetDay())
+
+
+def fetch_period_counts(worker, cache, sources, grant_sel, protocol_sel, key_field, indexes, timings):
+    """
+    Export the participants of the selected grants and protocols from every connected project and count them by
+    enrollment day, so any date range can be shown without exporting again. Runs on a Worker thread.
+    :param worker: Worker running the task
+    :param cache: RecordCache to report from, or None to export directly from REDCap
+    :param sources: list of (RedcapClient, ProjectMetadata) of the connected projects
+    :param grant_sel: labels of the selected grants
+    :param protocol_sel: labels of the selected protocols
+    :param key_field: field identifying a participant across projects, or None to count every record
+    :param indexes: EnrollmentIndex of each project's cached records from the previous update, or None
+    :param timings: Timings to add the stages of the update to
+    :return: merged PeriodCounts of the participants, the PeriodCounts of each project and their EnrollmentIndexes
+    """
+    return multi_project.run_combined_periods(sources, grant_sel, protocol_sel, key_field, cache, indexes, timings,
+                                              worker.progress)
+
+
+def export_participants(worker, path, counts, grant_sel, protocol_sel, sources, start, end, key_field, cache,
+                        indexes, total):
+    """
+    Write the summary table and participant extract of a report to a file. Runs on a Worker thread.
+    :param worker: Worker running the task
+    :param path: file to write, in the format given by its extension
+    :param counts: CountTable of the report
+    :param grant_sel: labels of the selected grants
+    :param protocol_sel: labels of the selected protocols
+    :param start: first enrollment date to include
+    :param end: last enrollment date to include
+    :param key_field: field identifying a participant across projects, or None
+    :param cache: RecordCache to export from, or None to export directly from REDCap
+    :param indexes: EnrollmentIndex of each project's cached records, or None
+    :param total: number of participants expected, for the progress gauge
+    :return: path written and the number of participants written
+    """
+    def reported(batches):
+        written = 0
+        for batch in batches:
+            yield batch
+            written += len(batch['record_id'])
+            worker.progress('Writing participants', written, total)
+
+    batches = report_export.extract_batches(sources, grant_sel, protocol_sel, start, end, key_field, cache, indexes,
+                                            worker.progress)
+    return path, report_export.export_report(path, counts, grant_sel, protocol_sel, reported(batches), key_field)
+
+
+def profile_task(worker, path, task, *args):
+    """
+    Run a worker task under cProfile. Runs on a Worker thread.
+    :param worker: Worker running the task
+    :param path: file to dump the profile to
+    :param task: task to run, called with the worker and args
+    :return: return value of the task
+    """
+    return profiled(path, task, worker, *args)
 
 
 class ReportWindow(wx.ScrolledWindow):
@@ -23,7 +96,25 @@ class ReportWindow(wx.ScrolledWindow):
         self.parent = parent
         # wx.ScrolledWindow.__init__(self, parent, -1, style=wx.TAB_TRAVERSAL)
 
-        self.participants = None  # To be filled on update with input options
+        self.counts = None  # CountTable of the participants shown in the output table, written on export
+        self.counts_range = None  # First and last enrollment date of counts
+        self.range_counts = None  # CountTable of the participants enrolled in the chosen date range
+        self.counted_range = None  # First and last enrollment date range_counts and periods were counted for
+        self.project_counts = []  # CountTable of each project before participants are merged
+        self.period_counts = None  # PeriodCounts of the participants of the counted selection, filled on update
+        self.project_period_counts = []  # PeriodCounts of each project
+        self.counted_selection = None  # Grant and protocol labels period_counts was counted for
+        self.periods = []  # Rows of the trend list, from PeriodCounts.periods
+        self.worker = None  # Worker running the current update
+        self.export_worker = None  # Worker writing a participant extract
+        self.enrollment_indexes = None  # EnrollmentIndex per project of the cached records, reused while unchanged
+        self.timings = None  # Timings of the last update
+        self.profile_path = None  # Profile of the last update, if it was profiled
+        # Handles to the cells of the output table, filled in by fill_zeros
+        self.count_cells = {}  # (race, ethnicity, gender) position to StaticText
+        self.race_total_cells = []  # One per race
+        self.column_total_cells = {}  # (ethnicity, gender) position to StaticText
+        self.total_cell = None
 
         # self = wx.Panel(self)
         self.Disable()  # disable interaction with main window
@@ -35,6 +126,9 @@ class ReportWindow(wx.ScrolledWindow):
         self.error = wx.StaticText(self)
         self.error.Hide()
         self.error.SetForegroundColour(wx.RED)
+        self.project_totals = wx.StaticText(self)  # Participants of each project, when there is more than one
+        self.project_totals.Hide()
+        self.table_title = wx.StaticText(self)  # Date range or period shown in the output table
 
         title = wx.StaticText(self, label='Cumulative Enrollment Report')
         title.SetFont(wx.Font().Bold())
@@ -45,15 +139,51 @@ class ReportWindow(wx.ScrolledWindow):
         self.end_date = wx.adv.DatePickerCtrl(self)
         self.grant_list = wx.ListBox(self, style=wx.LB_MULTIPLE)
         self.protocol_list = wx.ListBox(self, style=wx.LB_MULTIPLE)
-        update = wx.Button(self, label='Update')
-        update.SetDefault()
+        self.update_button = wx.Button(self, label='Update')
+        self.update_button.SetDefault()
         reset_button = wx.Button(self, label='Reset Options')
         self.export_button = wx.Button(self, label='Export to CSV')
         self.export_button.Disable()
-
-        update.Bind(wx.EVT_BUTTON, self.update)
+        self.export_participants_button = wx.Button(self, label='Export Participants...')
+        self.export_participants_button.Disable()
+
+        trend_title = wx.StaticText(self, label='Enrollment Trend')
+        trend_title.SetFont(wx.Font().Bold())
+        self.period_choice = wx.Choice(self, choices=[period.capitalize() for period in PERIODS])
+        self.period_choice.SetSelection(0)
+        self.cumulative_check = wx.CheckBox(self, label='Cumulative to date')
+        self.trend_list = wx.ListCtrl(self, size=wx.Size(520, 200), style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for column, heading in enumerate(['Period', 'From', 'To', 'Enrolled', 'Cumulative']):
+            self.trend_list.InsertColumn(column, heading)
+        self.export_trend_button = wx.Button(self, label='Export Trend to CSV')
+        self.export_trend_button.Disable()
+        self.trend_sizer = wx.BoxSizer()
+        self.trend_sizer.Add(self.period_choice, 0, wx.ALL | wx.CENTER, 5)
+        self.trend_sizer.Add(self.cumulative_check, 0, wx.ALL | wx.CENTER, 5)
+        self.trend_sizer.Add(self.export_trend_button, 0, wx.ALL | wx.CENTER, 5)
+
+        self.progress_sizer = wx.BoxSizer()
+        self.progress_text = wx.StaticText(self)
+        self.progress_gauge = wx.Gauge(self, range=100)
+        cancel_button = wx.Button(self, label='Cancel')
+        self.progress_sizer.Add(self.progress_text, 0, wx.ALL | wx.CENTER, 5)
+        self.progress_sizer.Add(self.progress_gauge, 0, wx.ALL | wx.CENTER, 5)
+        self.progress_sizer.Add(cancel_button, 0, wx.ALL | wx.CENTER, 5)
+
+        self.update_button.Bind(wx.EVT_BUTTON, self.update)
+        cancel_button.Bind(wx.EVT_BUTTON, self.on_cancel)
+        self.Bind(EVT_WORKER_PROGRESS, self.on_progress)
+        self.Bind(EVT_WORKER_DONE, self.on_update_done)
         reset_button.Bind(wx.EVT_BUTTON, self.on_reset)
         self.export_button.Bind(wx.EVT_BUTTON, self.on_export)
+        self.export_participants_button.Bind(wx.EVT_BUTTON, self.on_export_participants)
+        self.start_date.Bind(wx.adv.EVT_DATE_CHANGED, self.on_date_changed)
+        self.end_date.Bind(wx.adv.EVT_DATE_CHANGED, self.on_date_changed)
+        self.period_choice.Bind(wx.EVT_CHOICE, self.on_date_changed)
+        self.cumulative_check.Bind(wx.EVT_CHECKBOX, self.on_period_selected)
+        self.trend_list.Bind(wx.EVT_LIST_ITEM_SELECTED, self.on_period_selected)
+        self.trend_list.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.on_period_selected)
+        self.export_trend_button.Bind(wx.EVT_BUTTON, self.on_export_trend)
 
         self.input_sizer.Add(self.grant_list, 0, wx.ALL | wx.CENTER, 5)
         self.input_sizer.Add(self.protocol_list, 0, wx.ALL | wx.CENTER, 5)
@@ -61,17 +191,29 @@ class ReportWindow(wx.ScrolledWindow):
         self.input_sizer.Add(self.start_date, 0, wx.ALL | wx.CENTER, 5)
         self.input_sizer.Add(end_label, 0, wx.ALL | wx.CENTER, 5)
         self.input_sizer.Add(self.end_date, 0, wx.ALL | wx.CENTER, 5)
-        self.input_sizer.Add(update, 0, wx.ALL | wx.CENTER, 5)
+        self.input_sizer.Add(self.update_button, 0, wx.ALL | wx.CENTER, 5)
         self.input_sizer.Add(reset_button, 0, wx.ALL | wx.CENTER, 5)
         # self.input_sizer.Fit(self)
 
         self.sizer.Add(title, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.sizer.Add(self.input_sizer, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.sizer.Add(self.error, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.sizer.Add(self.progress_sizer, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.sizer.Hide(self.progress_sizer)
         self.sizer.Add(wx.StaticLine(self, -1), flag=wx.ALL | wx.EXPAND, border=5)
+        self.sizer.Add(self.table_title, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.sizer.Add(self.output_sizer, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.sizer.Add(self.project_totals, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.sizer.AddSpacer(20)
-        self.sizer.Add(self.export_button, 0, wx.RIGHT | wx.ALIGN_RIGHT, 50)
+        export_sizer = wx.BoxSizer()
+        export_sizer.Add(self.export_participants_button, 0, wx.ALL, 5)
+        export_sizer.Add(self.export_button, 0, wx.ALL, 5)
+        self.sizer.Add(export_sizer, 0, wx.RIGHT | wx.ALIGN_RIGHT, 50)
+        self.sizer.AddSpacer(20)
+        self.sizer.Add(wx.StaticLine(self, -1), flag=wx.ALL | wx.EXPAND, border=5)
+        self.sizer.Add(trend_title, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.sizer.Add(self.trend_sizer, 0, wx.ALL | wx.ALIGN_CENTER, 5)
+        self.sizer.Add(self.trend_list, 0, wx.ALL | wx.ALIGN_CENTER, 5)
         self.sizer.AddSpacer(20)
 
         self.SetSizer(self.sizer)
@@ -92,10 +234,11 @@ class ReportWindow(wx.ScrolledWindow):
         Opens file dialog to choose where to save, writes csv if save is chosen.
         :param evt: Event which triggered export
         """
-        with wx.FileDialog(self, "Filename to save", defaultFile='report_' +
-                                                                 self.start_date.GetValue().FormatISODate() +
-                                                                 '_to_' +
-                                                                 self.end_date.GetValue().FormatISODate() + '.csv',
+        if not self.counts or not self.counts.total:
+            self.show_error("Can't export when there is no data")
+            return
+        # Named after the dates of the table shown, which the date pickers may have moved on from
+        with wx.FileDialog(self, "Filename to save", defaultFile='report_{}_to_{}.csv'.format(*self.counts_range),
                            defaultDir=wx.StandardPaths.GetDocumentsDir(wx.StandardPaths.Get()),
                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
             if dlg.ShowModal() != wx.ID_CANCEL:
@@ -108,68 +251,89 @@ class ReportWindow(wx.ScrolledWindow):
 
     def do_save_file(self, file):
         """
-        Check for participants, if none show error and do nothing, otherwise write data to csv file.
+        Check for counted participants, if none show error and do nothing, otherwise write data to csv file.
         :param file: file to write to
         """
-        if not self.participants:
+        if not self.counts or not self.counts.total:
             self.show_error("Can't export when there is no data")
         else:
             self.write_to_file(file)
 
     def write_to_file(self, file):
         """
-        Calculate demographic measures and write to file in csv format.
+        Write demographic measures to file in csv format.
         :param file: file to write to
         """
-        report_writer = csv.writer(file, delimiter=',',
-                                   quotechar='|', quoting=csv.QUOTE_MINIMAL)
+        report_pipeline.write_report(file, self.counts, *self.counted_selection)
 
-        # Headers
-        report_writer.writerow(
-            ['Grants:'] + [self.grant_list.GetItems()[i] for i in self.grant_list.GetSelections()])
-        report_writer.writerow(['Protocols:'] + [self.protocol_list.GetItems()[i]
-                                                 for i in self.protocol_list.GetSelections()])
-        row = ['']
-        for eth in range(len(ETHNICITIES)):
-            for gen in range(len(GENDERS)):
-                row.append(ETHNICITIES[eth] + '/' + GENDERS[gen])
-        report_writer.writerow(row)
-
-        # Table and row sums
-        for race in range(len(RACES)):
-            row = [RACES[race]]
-            race_tot = 0
-            for eth in range(len(ETHNICITIES)):
-                for gen in range(len(GENDERS)):
-                    count = self.get_count_with_filter(self.participants, RACES[race], GENDERS[gen],
-                                                       ETHNICITIES[eth])
-                    race_tot += count
-                    row.append(count)
-            row.append(race_tot)
-            report_writer.writerow(row)
-
-        # Column sums
-        row = ['Totals by Gender and Ethnicity']
-        for eth in range(len(ETHNICITIES)):
-            for gen in range(len(GENDERS)):
-                gen_tot = 0
-                for race in range(len(RACES)):
-                    count = self.get_count_with_filter(self.participants, RACES[race], GENDERS[gen],
-                                                       ETHNICITIES[eth])
-                    gen_tot += count
-                row.append(gen_tot)
-        row.append(len(self.participants))
-        row.append('<- Total enrollments')
-        report_writer.writerow(row)
-
-    def fill_options(self):
+    def on_export_participants(self, evt):
+        """
+        Opens file dialog to choose where and in which format to save the participants of the date range with its
+        summary table, and writes them on a background worker if save is chosen.
+        :param evt: Event which triggered export
+        """
+        if not self.range_counts or not self.range_counts.total:
+            self.show_error("Can't export when there is no data")
+            return
+        wildcard = '|'.join('{} (*{})|*{}'.format(name, extension, extension)
+                            for extension, name in report_export.FORMATS.items())
+        with wx.FileDialog(self, "Filename to save", defaultFile='participants_{}_to_{}'.format(*self.counted_range),
+                           defaultDir=wx.StandardPaths.GetDocumentsDir(wx.StandardPaths.Get()),
+                           wildcard=wildcard, style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
+            if dlg.ShowModal() == wx.ID_CANCEL:
+                return
+            path = dlg.GetPath()
+            extension = list(report_export.FORMATS)[dlg.GetFilterIndex()]
+            if not path.lower().endswith(extension):
+                path += extension
+
+        self.error.Hide()
+        # The extract is exported for the dates of the summary, which the date pickers may have moved on from
+        self.export_worker = Worker(self, export_participants, path, self.range_counts, *self.counted_selection,
+                                    self.parent.sources, *self.counted_range, self.parent.participant_field,
+                                    self.parent.cache, self.enrollment_indexes,
+                                    sum(counts.total for counts in self.project_counts))
+        self.export_participants_button.Disable()
+        self.toggle_progress(show=True)
+        self.export_worker.start()
+
+    def on_export_done(self, evt):
+        """
+        Show the result of writing a participant extract
+        :param evt: WorkerDoneEvent of the export
+        """
+        self.export_worker = None
+        self.toggle_progress(show=False)
+        self.export_participants_button.Enable(enable=bool(self.range_counts and self.range_counts.total))
+        if evt.error:
+            self.show_error("Can't save file: {}".format(evt.error))
+        else:
+            wx.MessageBox('Wrote {1} participants to {0}'.format(*evt.result), 'Export Participants')
+
+    def on_export_trend(self, evt):
+        """
+        Opens file dialog to choose where to save the trend, writes one table per period if save is chosen.
+        :param evt: Event which triggered export
+        """
+        with wx.FileDialog(self, "Filename to save", defaultFile='trend_{}_to_{}.csv'.format(*self.counted_range),
+                           defaultDir=wx.StandardPaths.GetDocumentsDir(wx.StandardPaths.Get()),
+                           style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT) as dlg:
+            if dlg.ShowModal() != wx.ID_CANCEL:
+                try:
+                    with open(dlg.GetPath(), 'w', newline='') as file:
+                        report_pipeline.write_trend_report(file, self.periods, *self.counted_selection,
+                                                           cumulative=self.cumulative_check.IsChecked())
+                except IOError:
+                    self.show_error("Can't save file.")
+
+    def fill_options(self, grants, protocols):
         """
         Fill grant/protocol list widgets with options.
+        :param grants: grant labels, across all connected projects
+        :param protocols: protocol labels, across all connected projects
         """
-        self.grant_list.InsertItems([g.split(',')[1].strip() for g in self.parent.project.export_metadata(
-            fields=['grant'])[0]['select_choices_or_calculations'].split('|')], 0)
-        self.protocol_list.InsertItems([p.split(',')[1].strip() for p in self.parent.project.export_metadata(
-            fields=['protocol'])[0]['select_choices_or_calculations'].split('|')], 0)
+        self.grant_list.InsertItems(list(grants), 0)
+        self.protocol_list.InsertItems(list(protocols), 0)
         self.fill_output()
         # self.sizer.Fit(self)
 
@@ -241,34 +405,40 @@ class ReportWindow(wx.ScrolledWindow):
 
     def fill_zeros(self):
         """
-        Fill output table with 0s
+        Fill output table with 0s, keeping a handle to each cell so updates can set it directly
         """
-        for i in range(len(ETHNICITIES) + 1):
-            if i == len(ETHNICITIES):
-                self.fill_column((i * 4) + 2, '0')
-            else:
-                for j in range(len(GENDERS)):
-                    self.fill_column((i * 4) + 2 + j, '0')
+        for eth in range(len(ETHNICITIES)):
+            for gen in range(len(GENDERS)):
+                *cells, self.column_total_cells[eth, gen] = self.fill_column((eth * 4) + 2 + gen, '0')
+                for race, cell in enumerate(cells):
+                    self.count_cells[race, eth, gen] = cell
+        *self.race_total_cells, self.total_cell = self.fill_column((len(ETHNICITIES) * 4) + 2, '0')
 
     def fill_column(self, col, content):
         """
         Fill Given column with content
         :param col: column to fill
         :param content: content to fill with
+        :return: list of the StaticText cells added, one per race followed by the total
         """
-        for i in range(8):
+        cells = []
+        for i in range(len(RACES) + 1):
             offset = 0
-            if i == 7:
+            if i == len(RACES):
                 offset = 1  # Offset one at the end of the column to skip the divider row
-            self.output_sizer.Add(wx.StaticText(self, label=content), pos=(i + 4 + offset, col),
-                                  flag=wx.ALIGN_CENTER, border=5)
+            cell = wx.StaticText(self, label=content)
+            self.output_sizer.Add(cell, pos=(i + 4 + offset, col), flag=wx.ALIGN_CENTER, border=5)
+            cells.append(cell)
+        return cells
 
     def update(self, evt):
         """
-        Update output based on input choices
+        Start updating the output based on input choices. REDCap is queried on a background worker for every
+        enrollment of the selected grants and protocols, and the table is filled in when it finishes. Later changes
+        of the date range are shown from the same counts without an update.
         :param evt: event which triggered the update
         """
-        self.participants = None
+        self.counts = None
         self.error.Hide()
 
         if self.start_date.GetValue() > self.end_date.GetValue():
@@ -276,20 +446,209 @@ class ReportWindow(wx.ScrolledWindow):
             self.toggle_export_controls(enable=False)
             return
 
-        enrollments = self.parent.project.export_records(raw_or_label='label',
-                                                              fields=['enrollment', 'grant', 'protocol'])
-        grant_selection = [self.grant_list.GetItems()[i] for i in self.grant_list.GetSelections()]
-        protocol_selection = [self.protocol_list.GetItems()[i] for i in self.protocol_list.GetSelections()]
-        ids = self.filter_enrollments(enrollments, protocol_selection, grant_selection)
-        if ids:
-            self.participants = self.parent.project.export_records(records=ids, raw_or_label='label',
-                                                                   fields=['gender', 'ethnicity', 'race'])
-            self.fill_output_table(participants=self.participants)
+        self.timings = Timings()
+        args = (self.parent.cache, self.parent.sources, *self.selection(), self.parent.participant_field,
+                self.enrollment_indexes, self.timings)
+        if self.parent.menu_profile.IsChecked():
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            self.profile_path = os.path.join(PROFILE_DIR,
+                                             datetime.datetime.now().strftime('profile-%Y%m%d-%H%M%S.prof'))
+            self.worker = Worker(self, profile_task, self.profile_path, fetch_period_counts, *args)
+        else:
+            self.profile_path = None
+            self.worker = Worker(self, fetch_period_counts, *args)
+        self.toggle_export_controls(enable=False)
+        self.export_participants_button.Disable()
+        self.toggle_progress(show=True)
+        self.worker.start()
+
+    def on_update_done(self, evt):
+        """
+        Fill the output table with the result of an update
+        :param evt: WorkerDoneEvent of the update
+        """
+        if evt.worker is self.export_worker:
+            self.on_export_done(evt)
+            return
+        if evt.worker is not self.worker:
+            return  # Result of an update which has since been replaced
+        self.worker = None
+        self.toggle_progress(show=False)
+        if evt.error:
+            self.show_error(str(evt.error))
+            self.period_counts = None
+            self.project_period_counts = []
+        else:
+            self.period_counts, self.project_period_counts, self.enrollment_indexes = evt.result
+            self.counted_selection = self.selection()
+        with self.timings.stage('table refresh'):
+            self.show_range()
+        self.timings.finish()
+
+    def selection(self):
+        """
+        Grant and protocol labels selected in the list widgets
+        :return: (grant labels, protocol labels)
+        """
+        return ([self.grant_list.GetItems()[i] for i in self.grant_list.GetSelections()],
+                [self.protocol_list.GetItems()[i] for i in self.protocol_list.GetSelections()])
+
+    def show_range(self):
+        """
+        Show the counts of the chosen date range and its periods, read off the counts of the last update
+        """
+        self.periods = []
+        self.range_counts = None
+        self.counted_range = None
+        self.project_counts = []
+        if self.period_counts is not None:
+            start, end = to_date(self.start_date.GetValue()), to_date(self.end_date.GetValue())
+            self.range_counts = self.period_counts.between(start, end)
+            self.counted_range = (start, end)
+            self.project_counts = [counts.between(start, end) for counts in self.project_period_counts]
+            self.periods = self.period_counts.periods(start, end, PERIODS[self.period_choice.GetSelection()])
+        self.fill_trend_list()
+        self.show_project_totals()
+        self.show_counts()
+
+    def show_counts(self):
+        """
+        Fill the output table with the period selected in the trend list, or the whole date range if none is
+        """
+        selected = self.trend_list.GetFirstSelected()
+        self.counts = self.range_counts
+        self.counts_range = self.counted_range
+        if selected != -1 and selected < len(self.periods):
+            label, first, last, period, to_date_counts = self.periods[selected]
+            cumulative = self.cumulative_check.IsChecked()
+            self.counts = to_date_counts if cumulative else period
+            self.counts_range = (self.periods[0][1] if cumulative else first, last)
+        self.table_title.SetLabelText('{} to {}'.format(*self.counts_range) if self.counts is not None else '')
+        if self.counts and self.counts.total:
+            self.fill_output_table(counts=self.counts)
             self.toggle_export_controls(enable=True)
         else:
-            self.toggle_export_controls(enable=False)
             self.fill_output_table(string='0')
+            self.toggle_export_controls(enable=False)
+        self.export_trend_button.Enable(enable=bool(self.range_counts and self.range_counts.total))
+        self.export_participants_button.Enable(enable=bool(self.range_counts and self.range_counts.total and
+                                                           not self.export_worker))
+        self.Layout()
+
+    def fill_trend_list(self):
+        """
+        Fill the trend list with the participants enrolled in each period, and cumulatively to its end
+        """
+        self.trend_list.Freeze()
+        try:
+            self.trend_list.DeleteAllItems()
+            for row, (label, first, last, counts, to_date_counts) in enumerate(self.periods):
+                self.trend_list.InsertItem(row, label)
+                for column, value in enumerate([first.isoformat(), last.isoformat(), counts.total,
+                                                to_date_counts.total], 1):
+                    self.trend_list.SetItem(row, column, str(value))
+        finally:
+            self.trend_list.Thaw()
+
+    def on_date_changed(self, evt):
+        """
+        Update the output table for the new date range or period length straight away, if the grants and protocols
+        selected are those of the last update
+        :param evt: event which triggered the change
+        """
+        if self.period_counts is None or self.worker or self.selection() != self.counted_selection:
+            return
+        self.error.Hide()
+        if self.start_date.GetValue() > self.end_date.GetValue():
+            self.show_error('Start date must be earlier than end date.')
+            self.toggle_export_controls(enable=False)
+            return
+        self.show_range()
+
+    def on_period_selected(self, evt):
+        """
+        Show the table of the period selected in the trend list
+        :param evt: event which triggered the selection
+        """
+        self.show_counts()
+
+    def show_project_totals(self):
+        """
+        Show how many participants each project has when several are combined, and how many are counted once
+        merged
+        """
+        if len(self.project_counts) < 2 or not self.range_counts:
+            self.project_totals.Hide()
+            return
+        totals = ', '.join('project {}: {}'.format(i + 1, counts.total)
+                           for i, counts in enumerate(self.project_counts))
+        self.project_totals.SetLabelText('{} ({} counted once)'.format(totals, self.range_counts.total)
+                                         if self.parent.participant_field else totals)
+        self.project_totals.Show()
+        self.Layout()
+
+    def on_progress(self, evt):
+        """
+        Show progress of the running update
+        :param evt: WorkerProgressEvent of the update
+        """
+        if evt.worker not in (self.worker, self.export_worker):
+            return
+        self.progress_text.SetLabel(evt.message)
+        if evt.total:
+            self.progress_gauge.SetRange(evt.total)
+            self.progress_gauge.SetValue(evt.done)
+        else:
+            self.progress_gauge.Pulse()
+        self.Layout()
 
+    def on_cancel(self, evt):
+        """
+        Cancel the running update or export
+        :param evt: event which triggered the cancel
+        """
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+        if self.export_worker:
+            self.export_worker.cancel()
+            self.export_worker = None
+            self.export_participants_button.Enable(enable=bool(self.range_counts and self.range_counts.total))
+        self.toggle_progress(show=False)
+
+    def show_timings(self):
+        """
+        Show the time, records and bytes of each stage of the last update in a dialog, to copy into a ticket when
+        a report is slow
+        """
+        if self.timings is None:
+            text = 'Run an update to see how long each stage takes.'
+        else:
+            text = self.timings.report()
+            if self.profile_path:
+                text += '\n\nProfile written to {}'.format(self.profile_path)
+        dialog = wx.Dialog(self, title='Update Timings', style=wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER)
+        log = wx.TextCtrl(dialog, value=text, size=wx.Size(640, 240),
+                          style=wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL)
+        log.SetFont(wx.Font(wx.FontInfo().Family(wx.FONTFAMILY_TELETYPE)))
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(log, 1, wx.ALL | wx.EXPAND, 5)
+        sizer.Add(dialog.CreateButtonSizer(wx.OK), 0, wx.ALL | wx.ALIGN_RIGHT, 5)
+        dialog.SetSizerAndFit(sizer)
+        dialog.ShowModal()
+        dialog.Destroy()
+
+    def toggle_progress(self, show=True):
+        """
+        Show/hide the progress indicator, and disable/enable the Update button while an update runs.
+        :param show: whether to show or hide the progress indicator
+        """
+        self.update_button.Enable(enable=not show)
+        if show:
+            self.progress_text.SetLabel('')
+            self.progress_gauge.Pulse()
+        self.sizer.Show(self.progress_sizer, show=show)
+        self.Layout()
 
     def toggle_export_controls(self, enable=True):
         """
@@ -299,86 +658,36 @@ class ReportWindow(wx.ScrolledWindow):
         self.export_button.Enable(enable=enable)
         self.parent.menuExport.Enable(enable=enable)
 
-    def filter_enrollments(self, enrollments, protocol_sel, grant_sel):
-        """
-        Filter all grant/protocol pairs to match the input options pr_sel, gr_sel
-
-        :param enrollments: grant/protocol pairs from REDCap
-        :param protocol_sel: protocol selection list from input options
-        :param grant_sel: grant selection list from input options
-        :return: list of record ids which match the selection
+    def fill_output_table(self, counts=None, string=None):
         """
-        ids = []
-        for e in enrollments:
-            if e.get('grant') and e.get('protocol') and e.get('enrollment'):
-                if e.get('grant') in grant_sel and e.get('protocol') in protocol_sel:
-                    enrollment = wx.DateTime()
-                    enrollment.ParseISODate(e['enrollment'])
-                    if self.start_date.GetValue() <= enrollment <= self.end_date.GetValue():
-                        ids.append(e.get('record_id'))
-        return ids
-
-    def fill_output_table(self, participants=None, string=None):
-        """
-        Fill output table in application with demographic measures corresponding to the chosen options
-        :param participants: participants with enrollments that matched the input options
+        Fill output table in application with demographic measures corresponding to the chosen options. Each cell
+        whose text changes is set once, with drawing frozen until all of them are set.
+        :param counts: CountTable of the participants with enrollments that matched the input options
         :param string: optional string with which to fill each cell in the table
         """
-        race_totals = {}
-        for eth in range(len(ETHNICITIES)):
-            for gen in range(len(GENDERS)):
-                offset = 0
-                gen_tot = 0
-                for race in range(len(RACES)):
-                    if RACES[race] == 'Black':
-                        offset = -1
-                        continue
-                    count = 0
-                    if not string:
-                        count = self.get_count_with_filter(participants, RACES[race], GENDERS[gen], ETHNICITIES[eth])
-                    gen_tot += count
-                    race_totals[RACES[race]] = race_totals.get(RACES[race], 0) + count
-                    race_total_text = self.output_sizer.FindItemAtPosition((race + 4 + offset, 14))
-                    if race_total_text:
-                        if not string:
-                            race_total_text.GetWindow().SetLabelText(str(race_totals[RACES[race]]))
-                        else:
-                            race_total_text.GetWindow().SetLabelText(string)
-
-                    text = self.output_sizer.FindItemAtPosition((race + 4 + offset, (eth * 4) + gen + 2))
-                    if text:
-                        if not string:
-                            text.GetWindow().SetLabelText(str(count))
-                        else:
-                            text.GetWindow().SetLabelText(string)
-                text = self.output_sizer.FindItemAtPosition((len(RACES) + 1 + 4 + offset, (eth * 4) + gen + 2))
-                if text:
-                    if not string:
-                        text.GetWindow().SetLabelText(str(gen_tot))
-                    else:
-                        text.GetWindow().SetLabelText(string)
-        text = self.output_sizer.FindItemAtPosition((12, 14))
-        if text:
-            if not string:
-                text.GetWindow().SetLabelText(str(len(participants)))
-            else:
-                text.GetWindow().SetLabelText(string)
-
-    def get_count_with_filter(self, participants, race, gender, ethnicity):
-        """
-        Count participants which match the given criterion
-        :param participants: list of participants who match the input options
-        :param race: race to filter by
-        :param gender: gender to filter by
-        :param ethnicity: ethnicity to filter by
-        :return: number of participants which match the filter
-        """
-        count = 0
-        for p in participants:
-            if p['race'] == race and p['gender'] == gender and p['ethnicity'] == ethnicity:
-                count += 1
-
-        return count
+        if string:
+            labels = [(cell, string) for cell in [*self.count_cells.values(), *self.race_total_cells,
+                                                  *self.column_total_cells.values(), self.total_cell]]
+        else:
+            race_totals = counts.race_totals
+            column_totals = counts.column_totals
+            labels = [*((cell, counts.cube[key]) for key, cell in self.count_cells.items()),
+                      *zip(self.race_total_cells, race_totals),
+                      *((cell, column_totals[key]) for key, cell in self.column_total_cells.items()),
+                      (self.total_cell, counts.total)]
+
+        changed = False
+        self.Freeze()
+        try:
+            for cell, label in labels:
+                label = str(label)
+                if cell.GetLabelText() != label:
+                    cell.SetLabelText(label)
+                    changed = True
+        finally:
+            self.Thaw()
+        if changed:
+            self.output_sizer.Layout()
 
     def on_reset(self, evt):
         """
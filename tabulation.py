@@ -0,0 +1,179 @@
+"""
+Tabulation of NIH demographic measures into a race x ethnicity x gender count cube
+"""
+import numpy as np
+
+
+RACES = ['American Indian/Alaska Native', 'Asian', 'Native Hawaiian or Other Pacific Islander',
+         'Black or African American', 'White', 'More Than One Race', 'Unknown']
+ETHNICITIES = ['Not Hispanic or Latino', 'Hispanic or Latino', 'Unknown']
+GENDERS = ['Female', 'Male', 'Unknown']
+
+RACE_CODES = {label: i for i, label in enumerate(RACES)}
+ETHNICITY_CODES = {label: i for i, label in enumerate(ETHNICITIES)}
+GENDER_CODES = {label: i for i, label in enumerate(GENDERS)}
+
+CELLS = len(RACES) * len(ETHNICITIES) * len(GENDERS)
+
+# Lookups from exported race, ethnicity and gender values to their positions in RACES, ETHNICITIES and GENDERS,
+# for records exported as labels
+LABEL_LOOKUPS = (RACE_CODES, ETHNICITY_CODES, GENDER_CODES)
+
+# Values of an unticked race checkbox column in a raw export ('0'), or of a blank or missing column
+UNCHECKED = ('0', '', None)
+
+
+class CountTable:
+    """
+    Counts of participants by race, ethnicity and gender, with row, column and grand totals.
+    """
+
+    def __init__(self, cube=None, total=0):
+        """
+        :param cube: integer array of shape (races, ethnicities, genders), zeros if not given
+        :param total: number of participants tabulated, including any whose demographics matched no category
+        """
+        if cube is None:
+            cube = np.zeros((len(RACES), len(ETHNICITIES), len(GENDERS)), dtype=np.int64)
+        self.cube = cube
+        self.total = total
+
+    def __add__(self, other):
+        return CountTable(self.cube + other.cube, total=self.total + other.total)
+
+    def count(self, race, ethnicity, gender):
+        """
+        Count for a single cell, indexed by position in RACES, ETHNICITIES and GENDERS
+        """
+        return int(self.cube[race, ethnicity, gender])
+
+    @property
+    def race_totals(self):
+        """
+        Totals by race, one per entry in RACES
+        """
+        return self.cube.sum(axis=(1, 2))
+
+    @property
+    def column_totals(self):
+        """
+        Totals by ethnicity and gender, shape (ethnicities, genders)
+        """
+        return self.cube.sum(axis=0)
+
+
+def raw_lookups(race_choices, ethnicity_choices, gender_choices):
+    """
+    Lookups from raw choice codes to positions in RACES, ETHNICITIES and GENDERS, through the labels of the data
+    dictionary, for records exported as raw codes
+    :param race_choices: dict of race choice code to label
+    :param ethnicity_choices: dict of ethnicity choice code to label
+    :param gender_choices: dict of gender choice code to label
+    :return: (race, ethnicity, gender) lookups. Codes whose label is not a category are left out.
+    """
+    return tuple({code: categories[label] for code, label in choices.items() if label in categories}
+                 for choices, categories in ((race_choices, RACE_CODES), (ethnicity_choices, ETHNICITY_CODES),
+                                             (gender_choices, GENDER_CODES)))
+
+
+class RaceCheckboxes:
+    """
+    Lookup for a race checkbox field, which REDCap exports as one race___<code> column per choice. Only built for
+    records exported as raw codes, where ticked boxes are '1' and unticked boxes '0'.
+
+    Each participant's ticked boxes are packed into a bitmask of the RACES they fall in, and the bitmasks of a whole
+    batch are mapped to a race at once through a table over every possible mask: ticking races of more than one
+    category, or the More Than One Race box, gives More Than One Race, and ticking none gives Unknown.
+    """
+
+    def __init__(self, choices, field='race'):
+        """
+        :param choices: dict of race choice code to label. Labels which are not in RACES count as Unknown.
+        :param field: name of the checkbox field
+        """
+        self.bits = [('{}___{}'.format(field, code.lower().replace('-', '_')),
+                      1 << RACE_CODES.get(label, RACE_CODES['Unknown'])) for code, label in choices.items()]
+
+        more = RACE_CODES['More Than One Race']
+        masks = np.arange(1 << len(RACES))
+        single = masks & ((1 << more) - 1)  # Bits of the races before More Than One Race in RACES
+        ticked = sum((single >> i) & 1 for i in range(more))
+        self.table = np.full(len(masks), RACE_CODES['Unknown'], dtype=np.int64)
+        self.table[ticked == 1] = np.log2(single[ticked == 1]).astype(np.int64)
+        self.table[(ticked > 1) | (masks & (1 << more) > 0)] = more
+
+    def pack(self, participant):
+        """
+        Bitmask of the races ticked for a participant
+        :param participant: participant dict with race___<code> values
+        :return: integer with bit i set if a box of RACES[i] is ticked
+        """
+        mask = 0
+        for column, bit in self.bits:
+            if participant.get(column) not in UNCHECKED:
+                mask |= bit
+        return mask
+
+    def races(self, masks):
+        """
+        Race of each participant
+        :param masks: integer array of bitmasks from pack
+        :return: integer array of positions in RACES
+        """
+        return self.table[masks]
+
+
+def demographic_codes(participants, lookups=LABEL_LOOKUPS):
+    """
+    Positions of each participant's race, ethnicity and gender in RACES, ETHNICITIES and GENDERS
+    :param participants: iterable of participant dicts with 'race', 'ethnicity' and 'gender' values, or with
+        race___<code> values if the race lookup is a RaceCheckboxes
+    :param lookups: (race, ethnicity, gender) lookups from exported values to category positions
+    :return: race, ethnicity and gender integer arrays with one position per participant, -1 where the value
+        matched no category
+    """
+    races, ethnicities, genders = lookups
+    checkbox = isinstance(races, RaceCheckboxes)
+    codes = []
+    for p in participants:
+        codes.append((races.pack(p) if checkbox else races.get(p.get('race'), -1),
+                      ethnicities.get(p.get('ethnicity'), -1), genders.get(p.get('gender'), -1)))
+    codes = np.asarray(codes, dtype=np.int64).reshape((-1, 3))
+    race, eth, gen = codes[:, 0], codes[:, 1], codes[:, 2]
+    if checkbox:
+        race = races.races(race)
+    return race, eth, gen
+
+
+def cell_codes(participants, lookups=LABEL_LOOKUPS):
+    """
+    Position of each participant's race/ethnicity/gender cell in a flattened count cube
+    :param participants: iterable of participant dicts, see demographic_codes
+    :param lookups: (race, ethnicity, gender) lookups from exported values to category positions
+    :return: integer array with one cell per participant, -1 where the demographics matched no category
+    """
+    race, eth, gen = demographic_codes(participants, lookups)
+    cells = (race * len(ETHNICITIES) + eth) * len(GENDERS) + gen
+    cells[(race < 0) | (eth < 0) | (gen < 0)] = -1
+    return cells
+
+
+def count_cells(cells):
+    """
+    Count cell codes into a CountTable
+    :param cells: integer array of cell codes from cell_codes
+    :return: CountTable of the cells
+    """
+    cube = np.bincount(cells[cells >= 0], minlength=CELLS).reshape((len(RACES), len(ETHNICITIES), len(GENDERS)))
+    return CountTable(cube, total=len(cells))
+
+
+def tabulate(participants, lookups=LABEL_LOOKUPS):
+    """
+    Count participants into a CountTable in a single pass. Only the cell of each participant is kept, so
+    participants can be streamed from a generator.
+    :param participants: iterable of participant dicts with 'race', 'ethnicity' and 'gender' values
+    :param lookups: (race, ethnicity, gender) lookups from exported values to category positions
+    :return: CountTable of the participants
+    """
+    return count_cells(cell_codes(participants, lookups))
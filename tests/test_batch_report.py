@@ -0,0 +1,85 @@
+import datetime
+import random
+
+import pytest
+
+from batch_report import ReportSpec, compute_batch
+from tabulation import ETHNICITIES, GENDERS, RACES
+
+GRANTS = ['Grant 1', 'Grant 2', 'Grant 3']
+PROTOCOLS = ['Protocol 1', 'Protocol 2']
+FIRST_DAY = datetime.date(2020, 1, 1)
+
+
+def random_records(rng, size, days=40):
+    records = []
+    for i in range(size):
+        enrollment = (FIRST_DAY + datetime.timedelta(days=rng.randrange(days))).isoformat()
+        records.append({'record_id': str(i + 1),
+                        'enrollment': rng.choice([enrollment] * 8 + [enrollment + ' 13:45', '']),
+                        'grant': rng.choice(GRANTS + ['']), 'protocol': rng.choice(PROTOCOLS),
+                        'race': rng.choice(RACES + ['']), 'ethnicity': rng.choice(ETHNICITIES),
+                        'gender': rng.choice(GENDERS + ['Other'])})
+    return records
+
+
+def random_specs(rng, count, days=40):
+    specs = []
+    for i in range(count):
+        start = FIRST_DAY + datetime.timedelta(days=rng.randrange(-5, days))
+        end = start + datetime.timedelta(days=rng.randrange(0, 15))
+        specs.append(ReportSpec('report {}'.format(i), rng.sample(GRANTS, rng.randint(1, len(GRANTS))),
+                                rng.sample(PROTOCOLS, rng.randint(1, len(PROTOCOLS))), start, end))
+    return specs
+
+
+def brute_force(records, spec):
+    cube = {}
+    total = 0
+    for r in records:
+        if not r['enrollment'] or r['grant'] not in spec.grants or r['protocol'] not in spec.protocols:
+            continue
+        if not spec.start <= datetime.date.fromisoformat(r['enrollment'][:10]) <= spec.end:
+            continue
+        total += 1
+        if r['race'] in RACES and r['ethnicity'] in ETHNICITIES and r['gender'] in GENDERS:
+            cell = (RACES.index(r['race']), ETHNICITIES.index(r['ethnicity']), GENDERS.index(r['gender']))
+            cube[cell] = cube.get(cell, 0) + 1
+    return cube, total
+
+
+def assert_matches(table, expected):
+    cube, total = expected
+    assert table.total == total
+    for race in range(len(RACES)):
+        for ethnicity in range(len(ETHNICITIES)):
+            for gender in range(len(GENDERS)):
+                assert table.count(race, ethnicity, gender) == cube.get((race, ethnicity, gender), 0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_compute_batch_matches_brute_force(seed):
+    rng = random.Random(seed)
+    records = random_records(rng, 500)
+    specs = random_specs(rng, 12)
+    for spec, table in zip(specs, compute_batch(records, specs)):
+        assert_matches(table, brute_force(records, spec))
+
+
+def test_period_boundaries():
+    day = datetime.timedelta(days=1)
+    records = [{'enrollment': (FIRST_DAY + i * day).isoformat(), 'grant': 'Grant 1', 'protocol': 'Protocol 1',
+                'race': 'Asian', 'ethnicity': 'Unknown', 'gender': 'Female'} for i in range(10)]
+    specs = [ReportSpec('first day', ['Grant 1'], ['Protocol 1'], FIRST_DAY, FIRST_DAY),
+             ReportSpec('adjoining', ['Grant 1'], ['Protocol 1'], FIRST_DAY + day, FIRST_DAY + 4 * day),
+             ReportSpec('overlapping', ['Grant 1'], ['Protocol 1'], FIRST_DAY + 3 * day, FIRST_DAY + 6 * day),
+             ReportSpec('last day', ['Grant 1'], ['Protocol 1'], FIRST_DAY + 9 * day, FIRST_DAY + 20 * day),
+             ReportSpec('before', ['Grant 1'], ['Protocol 1'], FIRST_DAY - 5 * day, FIRST_DAY - day),
+             ReportSpec('after', ['Grant 1'], ['Protocol 1'], FIRST_DAY + 10 * day, FIRST_DAY + 20 * day),
+             ReportSpec('other grant', ['Grant 2'], ['Protocol 1'], FIRST_DAY, FIRST_DAY + 20 * day)]
+    assert [table.total for table in compute_batch(records, specs)] == [1, 4, 4, 1, 0, 0, 0]
+
+
+def test_no_records():
+    specs = random_specs(random.Random(0), 3)
+    assert [table.total for table in compute_batch([], specs)] == [0, 0, 0]
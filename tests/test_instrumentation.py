@@ -0,0 +1,53 @@
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import Timings, profiled, profiled_task
+
+
+def slow_items(count, seconds):
+    for i in range(count):
+        time.sleep(seconds)
+        yield i
+
+
+def test_stage_leaves_out_items_fetched_within_it():
+    timings = Timings()
+    with timings.stage('tabulation') as stage:
+        for _ in timings.iterate('export', slow_items(5, 0.02)):
+            stage.records += 1
+        time.sleep(0.05)
+    timings.finish()
+    export, tabulation = timings.stages['export'], timings.stages['tabulation']
+    assert export.records == tabulation.records == 5
+    assert export.seconds >= 0.1
+    assert 0.05 <= tabulation.seconds < 0.1
+    assert export.seconds + tabulation.seconds <= timings.finished - timings.started
+
+
+def test_nested_stages_are_left_out_of_the_enclosing_stage():
+    timings = Timings()
+    with timings.stage('report'):
+        with timings.stage('sync'):
+            time.sleep(0.05)
+    assert timings.stages['sync'].seconds >= 0.05
+    assert timings.stages['report'].seconds < 0.05
+
+
+def pool_task(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def run_pool():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return list(executor.map(profiled_task(pool_task), [0.01, 0.02]))
+
+
+def test_profile_includes_worker_threads(tmp_path):
+    path = str(tmp_path / 'report.prof')
+    assert profiled(path, run_pool) == [0.01, 0.02]
+    calls = {function: stats[0] for (_, _, function), stats in pstats.Stats(path).stats.items()}
+    assert calls['pool_task'] == 2 and calls['run_pool'] == 1
+    # Outside a profiled call tasks run as they are
+    assert profiled_task(pool_task) is pool_task
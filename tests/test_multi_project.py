@@ -0,0 +1,75 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from benchmarks.fake_redcap import FakeRedcapServer, SyntheticProject
+from multi_project import combined_choices, connect_all, run_combined_report
+from record_cache import REPORT_FIELDS, RecordCache
+from tabulation import ETHNICITIES, GENDERS, count_cells
+
+GRANTS = ['Grant 1', 'Grant 3', 'Grant 5']  # Grant 5 is not a choice of the second project
+PROTOCOLS = ['Protocol {}'.format(i) for i in range(1, 7)]
+START, END = datetime.date(2016, 3, 1), datetime.date(2018, 6, 30)
+
+
+@pytest.fixture(scope='module')
+def projects():
+    # Participants drawn from a small pool, so many are enrolled in both projects and several times in one
+    return [SyntheticProject(600, grants=5, seed=1, participants=150),
+            SyntheticProject(400, grants=3, seed=2, participants=150)]
+
+
+@pytest.fixture(scope='module')
+def sources(projects):
+    with FakeRedcapServer(projects[0], projects={'A': projects[0], 'B': projects[1]}) as server:
+        yield connect_all(server.url, ['A', 'B'])
+
+
+def selected(project):
+    grants = [int(code) for code, label in project.choices['grant'].items() if label in GRANTS]
+    protocols = [int(code) for code, label in project.choices['protocol'].items() if label in PROTOCOLS]
+    values = project.values
+    return np.flatnonzero(np.isin(values['grant'], grants) & np.isin(values['protocol'], protocols) &
+                          (values['enrollment'] >= START.toordinal()) & (values['enrollment'] <= END.toordinal()))
+
+
+def cell(project, position):
+    race, ethnicity, gender = (project.values[field][position] - 1 for field in ('race', 'ethnicity', 'gender'))
+    return (race * len(ETHNICITIES) + ethnicity) * len(GENDERS) + gender
+
+
+def brute_force(projects, keyed):
+    enrollments = sorted((project.values['enrollment'][position], i, position)
+                         for i, project in enumerate(projects) for position in selected(project))
+    counted = set()
+    cells = []
+    for _, i, position in enrollments:
+        key = projects[i].values['participant_id'][position] if keyed else (i, position)
+        if key not in counted:
+            counted.add(key)
+            cells.append(cell(projects[i], position))
+    return count_cells(np.array(cells, dtype=np.int64))
+
+
+def assert_same(table, expected):
+    assert table.total == expected.total
+    assert (table.cube == expected.cube).all()
+
+
+@pytest.mark.parametrize('cached', [False, True])
+@pytest.mark.parametrize('key_field', [None, 'participant_id'])
+def test_combined_report_matches_brute_force(tmp_path, projects, sources, key_field, cached):
+    cache = RecordCache(str(tmp_path / 'cache.sqlite'), REPORT_FIELDS + ['participant_id'],
+                        raw_or_label='raw') if cached else None
+    merged, tables, indexes = run_combined_report(sources, GRANTS, PROTOCOLS, START, END, key_field, cache)
+    assert_same(merged, brute_force(projects, keyed=key_field is not None))
+    for table, project in zip(tables, projects):
+        assert_same(table, brute_force([project], keyed=False))
+    assert len(indexes) == 2 and all((index is not None) == cached for index in indexes)
+    if key_field:
+        assert merged.total < sum(table.total for table in tables)
+
+
+def test_combined_choices(sources):
+    assert combined_choices(sources, 'grant') == ['Grant {}'.format(i) for i in range(1, 6)]
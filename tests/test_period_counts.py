@@ -0,0 +1,120 @@
+import datetime
+import random
+
+import numpy as np
+import pytest
+
+from period_counts import KeyedPeriodCounts, PeriodCounts, period_ranges
+from tabulation import CELLS, count_cells
+
+FIRST_DAY = datetime.date(2020, 1, 1)
+
+
+def random_participants(rng, size, days=100):
+    dates = np.array([FIRST_DAY.toordinal() + rng.randrange(days) for _ in range(size)], dtype=np.int64)
+    cells = np.array([rng.randrange(-1, CELLS) for _ in range(size)], dtype=np.int64)
+    return dates, cells
+
+
+def brute_force(dates, cells, start, end):
+    return count_cells(cells[(dates >= start.toordinal()) & (dates <= end.toordinal())])
+
+
+def assert_same(table, expected):
+    assert table.total == expected.total
+    assert (table.cube == expected.cube).all()
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_between_matches_brute_force(seed):
+    rng = random.Random(seed)
+    dates, cells = random_participants(rng, 300)
+    counts = PeriodCounts(dates, cells)
+    assert len(counts) == len(dates)
+    for _ in range(50):
+        # Ranges start before, within and after the enrollments, so rows are clipped at both ends
+        start = FIRST_DAY + datetime.timedelta(days=rng.randrange(-30, 130))
+        end = start + datetime.timedelta(days=rng.randrange(0, 60))
+        assert_same(counts.between(start, end), brute_force(dates, cells, start, end))
+
+
+def test_between_clips_to_enrollments():
+    day = datetime.timedelta(days=1)
+    counts = PeriodCounts([FIRST_DAY.toordinal(), (FIRST_DAY + 2 * day).toordinal()], [0, 5])
+    assert counts.between(FIRST_DAY - 10 * day, FIRST_DAY - day).total == 0
+    assert counts.between(FIRST_DAY + 3 * day, FIRST_DAY + 10 * day).total == 0
+    assert counts.between(FIRST_DAY - 10 * day, FIRST_DAY).total == 1
+    assert counts.between(FIRST_DAY + day, FIRST_DAY + day).total == 0
+    assert counts.between(FIRST_DAY + 2 * day, FIRST_DAY + 10 * day).total == 1
+    assert counts.between(FIRST_DAY - 10 * day, FIRST_DAY + 10 * day).total == 2
+
+
+def test_no_participants():
+    counts = PeriodCounts([], [])
+    assert len(counts) == 0
+    assert counts.between(FIRST_DAY, FIRST_DAY + datetime.timedelta(days=10)).total == 0
+
+
+
+def test_far_apart_dates_keep_one_row_per_day():
+    # A mistyped year a millennium off only adds a row, not a row for every day in between
+    typo = datetime.date(1020, 1, 1)
+    days = [typo, FIRST_DAY, FIRST_DAY, FIRST_DAY + datetime.timedelta(days=5)]
+    dates = np.array([day.toordinal() for day in days], dtype=np.int64)
+    cells = np.array([3, 4, -1, 5], dtype=np.int64)
+    counts = PeriodCounts(dates, cells)
+    assert counts.cumulative.shape == (4, CELLS + 1)
+    assert_same(counts.between(typo, FIRST_DAY), brute_force(dates, cells, typo, FIRST_DAY))
+    assert counts.between(typo + datetime.timedelta(days=1), FIRST_DAY - datetime.timedelta(days=1)).total == 0
+    assert counts.between(FIRST_DAY + datetime.timedelta(days=1), FIRST_DAY + datetime.timedelta(days=10)).total == 1
+
+@pytest.mark.parametrize('period', ['month', 'quarter'])
+def test_periods_match_brute_force(period):
+    rng = random.Random(1)
+    dates, cells = random_participants(rng, 400, days=300)
+    start, end = FIRST_DAY + datetime.timedelta(days=20), FIRST_DAY + datetime.timedelta(days=250)
+    periods = PeriodCounts(dates, cells).periods(start, end, period)
+    assert [(label, first, last) for label, first, last, _, _ in periods] == period_ranges(start, end, period)
+    for _, first, last, table, to_date in periods:
+        assert_same(table, brute_force(dates, cells, first, last))
+        assert_same(to_date, brute_force(dates, cells, start, last))
+
+
+def brute_force_keyed(dates, cells, keys, start, end):
+    counted = set()
+    first = []
+    for position in sorted(range(len(dates)), key=lambda i: (dates[i], i)):
+        if start.toordinal() <= dates[position] <= end.toordinal():
+            if keys[position] is None or keys[position] not in counted:
+                counted.add(keys[position])
+                first.append(cells[position])
+    return count_cells(np.array(first, dtype=np.int64))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_keyed_between_matches_brute_force(seed):
+    rng = random.Random(seed)
+    dates, cells = random_participants(rng, 300)
+    # Few keys, so most participants are enrolled several times, some on the same day
+    keys = [rng.choice([None, 'A', 'B', 'C'] + ['P{}'.format(i) for i in range(60)]) for _ in range(len(dates))]
+    counts = KeyedPeriodCounts(dates, cells, keys)
+    assert len(counts) == len({key for key in keys if key is not None}) + keys.count(None)
+    for _ in range(50):
+        start = FIRST_DAY + datetime.timedelta(days=rng.randrange(-30, 130))
+        end = start + datetime.timedelta(days=rng.randrange(0, 60))
+        assert_same(counts.between(start, end), brute_force_keyed(dates, cells, keys, start, end))
+    start, end = FIRST_DAY, FIRST_DAY + datetime.timedelta(days=99)
+    for _, first, last, table, to_date in counts.periods(start, end, 'month'):
+        assert_same(table, brute_force_keyed(dates, cells, keys, first, last))
+        assert_same(to_date, brute_force_keyed(dates, cells, keys, start, last))
+
+
+def test_keyed_counts_participants_in_every_range_they_are_enrolled_in():
+    day = datetime.timedelta(days=1)
+    dates = [FIRST_DAY.toordinal(), (FIRST_DAY + 10 * day).toordinal(), (FIRST_DAY + 10 * day).toordinal()]
+    counts = KeyedPeriodCounts(dates, [1, 2, 3], ['A', 'A', 'A'])
+    assert counts.between(FIRST_DAY, FIRST_DAY + 20 * day).cube.flat[1] == 1
+    # Enrolled before the range too, but still counted in it, with the first enrollment of the day
+    later = counts.between(FIRST_DAY + day, FIRST_DAY + 20 * day)
+    assert later.total == 1 and later.cube.flat[2] == 1
+    assert counts.between(FIRST_DAY + day, FIRST_DAY + 9 * day).total == 0
@@ -0,0 +1,117 @@
+import datetime
+
+import pytest
+
+from benchmarks.fake_redcap import FakeRedcapServer, SyntheticProject
+from project_metadata import connect
+from record_cache import REPORT_FIELDS, RecordCache
+
+
+@pytest.fixture
+def synthetic():
+    project = SyntheticProject(200, seed=1, participants=50)
+    project.modified = datetime.datetime.now() - datetime.timedelta(days=7)
+    return project
+
+
+@pytest.fixture
+def server(synthetic):
+    with FakeRedcapServer(synthetic) as server:
+        server.requests = []
+        respond = server.respond
+        server.respond = lambda params: server.requests.append(params) or respond(params)
+        yield server
+
+
+def record_exports(server):
+    return [params for params in server.requests if params.get('content') == 'record']
+
+
+def field_exports(server):
+    # Exports of the cached fields, leaving out the exports of the current record ids
+    return [params for params in record_exports(server) if 'fields[1]' in params]
+
+
+def cached(cache, project):
+    return {r['record_id']: r for r in cache.records(project)}
+
+
+def test_first_sync_exports_every_record(tmp_path, server, synthetic):
+    project, _ = connect(server.url, 'TOKEN')
+    cache = RecordCache(str(tmp_path / 'cache.sqlite'), raw_or_label='raw', min_sync_interval=0)
+    assert cache.sync(project)
+    records = cached(cache, project)
+    assert len(records) == synthetic.size
+    assert records['1']['gender'] == str(synthetic.values['gender'][0])
+    assert set(records['1']) == {'record_id'} | set(REPORT_FIELDS)
+    assert 'dateRangeBegin' not in field_exports(server)[-1]
+
+
+def test_recent_sync_is_reused(tmp_path, server):
+    project, _ = connect(server.url, 'TOKEN')
+    cache = RecordCache(str(tmp_path / 'cache.sqlite'), raw_or_label='raw', min_sync_interval=300)
+    assert cache.sync(project)
+    exports = len(record_exports(server))
+    assert not cache.sync(project)
+    assert len(record_exports(server)) == exports
+    assert cache.sync(project, force=True)
+
+
+def test_incremental_sync_exports_changed_records(tmp_path, server, synthetic):
+    project, _ = connect(server.url, 'TOKEN')
+    cache = RecordCache(str(tmp_path / 'cache.sqlite'), raw_or_label='raw', min_sync_interval=0)
+    cache.sync(project)
+    synthetic.values['gender'][4] = synthetic.values['gender'][4] % 3 + 1
+    synthetic.modified = datetime.datetime.now()
+    server.requests.clear()
+
+    assert cache.sync(project)
+    changed, = field_exports(server)
+    assert changed.get('dateRangeBegin')
+    assert len(record_exports(server)) == 2
+    records = cached(cache, project)
+    assert len(records) == synthetic.size
+    assert records['5']['gender'] == str(synthetic.values['gender'][4])
+
+
+def test_incremental_sync_drops_deleted_records(tmp_path, server, synthetic):
+    project, _ = connect(server.url, 'TOKEN')
+    cache = RecordCache(str(tmp_path / 'cache.sqlite'), raw_or_label='raw', min_sync_interval=0)
+    cache.sync(project)
+    synthetic.size -= 15  # The last records are deleted, nothing is modified
+    server.requests.clear()
+
+    assert cache.sync(project)
+    assert all(params.get('dateRangeBegin') for params in field_exports(server))
+    records = cached(cache, project)
+    assert len(records) == synthetic.size
+    assert str(synthetic.size) in records and str(synthetic.size + 1) not in records
+    assert len(list(cache.records(project, ['1', str(synthetic.size + 1)]))) == 1
+
+
+def test_caches_of_other_fields_are_kept_apart(tmp_path, server):
+    project, _ = connect(server.url, 'TOKEN')
+    path = str(tmp_path / 'cache.sqlite')
+    report = RecordCache(path, raw_or_label='raw', min_sync_interval=0)
+    participants = RecordCache(path, REPORT_FIELDS + ['participant_id'], raw_or_label='raw', min_sync_interval=0)
+    labels = RecordCache(path, raw_or_label='label', min_sync_interval=0)
+    for cache in (report, participants, labels):
+        cache.sync(project)
+    server.requests.clear()
+
+    # Each cache only asks for changes, rather than exporting the project again after the others synced
+    for cache in (report, participants, labels):
+        assert cache.sync(project)
+    assert len(field_exports(server)) == 3
+    assert all(params.get('dateRangeBegin') for params in field_exports(server))
+    assert 'participant_id' not in cached(report, project)['1']
+    assert 'participant_id' in cached(participants, project)['1']
+    assert cached(labels, project)['1']['gender'] != cached(report, project)['1']['gender']
+
+
+def test_metadata_is_shared(tmp_path, server, synthetic):
+    path = str(tmp_path / 'cache.sqlite')
+    connect(server.url, 'TOKEN', RecordCache(path, raw_or_label='raw'))
+    project, metadata = connect(server.url, 'TOKEN', RecordCache(path, REPORT_FIELDS + ['participant_id']))
+    assert metadata.choices('grant') == synthetic.choices['grant']
+    assert sum(params.get('content') == 'metadata' for params in server.requests) == 1
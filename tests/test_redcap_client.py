@@ -0,0 +1,89 @@
+import socket
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import redcap_client
+from redcap_client import RedcapClient
+
+
+class ScriptedServer:
+    """
+    Local HTTP server answering each request with the next of a list of statuses
+    """
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                status = server.statuses[min(server.requests, len(server.statuses) - 1)]
+                server.requests += 1
+                body = b'{"error": "busy"}' if status >= 400 else b'10.0.0'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/api/'.format(self.server.server_port)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(redcap_client, 'time', types.SimpleNamespace(sleep=sleeps.append))
+    return sleeps
+
+
+def test_transient_errors_are_retried_with_backoff(sleeps):
+    with ScriptedServer([503, 502, 200]) as server:
+        client = RedcapClient(server.url, 'TOKEN', lazy=True, retries=3, backoff=0.5)
+        response = client.post({'content': 'version'})
+        assert response.status_code == 200 and response.text == '10.0.0'
+    assert server.requests == 3
+    assert sleeps == [0.5, 1.0]
+
+
+def test_last_error_is_returned_after_the_retries(sleeps):
+    with ScriptedServer([500]) as server:
+        client = RedcapClient(server.url, 'TOKEN', lazy=True, retries=2, backoff=1.0)
+        assert client.post({'content': 'version'}).status_code == 500
+    assert server.requests == 3
+    assert sleeps == [1.0, 2.0]
+
+
+def test_other_errors_are_not_retried(sleeps):
+    with ScriptedServer([403, 200]) as server:
+        client = RedcapClient(server.url, 'TOKEN', lazy=True)
+        assert client.post({'content': 'version'}).status_code == 403
+    assert server.requests == 1
+    assert sleeps == []
+
+
+def test_connection_errors_are_raised_after_the_retries(sleeps):
+    # A port nothing listens on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    client = RedcapClient('http://127.0.0.1:{}/api/'.format(port), 'TOKEN', lazy=True, retries=2, backoff=0.25)
+    with pytest.raises(requests.ConnectionError):
+        client.post({'content': 'version'})
+    assert sleeps == [0.25, 0.5]
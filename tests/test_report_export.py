@@ -0,0 +1,110 @@
+import csv
+import datetime
+import re
+import zipfile
+
+import numpy as np
+import pytest
+
+import report_export
+from benchmarks.fake_redcap import FakeRedcapServer, SyntheticProject
+from multi_project import connect_all, run_combined_report
+from report_export import export_report, extract_batches, summary_path, summary_rows
+from report_pipeline import report_rows
+from tabulation import ETHNICITIES, GENDERS, RACES
+
+GRANTS = ['Grant 1', 'Grant 2']
+PROTOCOLS = ['Protocol {}'.format(i) for i in range(1, 6)]
+START, END = datetime.date(2016, 1, 1), datetime.date(2017, 12, 31)
+COLUMNS = ['project', 'record_id', 'participant_id', 'enrollment', 'grant', 'protocol', 'race', 'ethnicity',
+           'gender']
+
+
+@pytest.fixture(scope='module')
+def projects():
+    return [SyntheticProject(1500, seed=4, participants=500), SyntheticProject(1000, seed=5, participants=500)]
+
+
+@pytest.fixture(scope='module')
+def sources(projects):
+    with FakeRedcapServer(projects[0], projects={'A': projects[0], 'B': projects[1]}) as server:
+        yield connect_all(server.url, ['A', 'B'])
+
+
+@pytest.fixture
+def report(sources, monkeypatch):
+    # Small batches, so the extract is written in several
+    monkeypatch.setattr(report_export, 'EXPORT_BATCH_SIZE', 7)
+    counts, _, _ = run_combined_report(sources, GRANTS, PROTOCOLS, START, END, 'participant_id')
+    return counts, extract_batches(sources, GRANTS, PROTOCOLS, START, END, 'participant_id')
+
+
+def expected_rows(projects):
+    # Rows of the extract as csv text, in export order: project by project, by record id
+    rows = []
+    for i, project in enumerate(projects):
+        values = project.values
+        grants = [int(c) for c, label in project.choices['grant'].items() if label in GRANTS]
+        protocols = [int(c) for c, label in project.choices['protocol'].items() if label in PROTOCOLS]
+        for p in np.flatnonzero(np.isin(values['grant'], grants) & np.isin(values['protocol'], protocols) &
+                                (values['enrollment'] >= START.toordinal()) &
+                                (values['enrollment'] <= END.toordinal())):
+            rows.append([str(i + 1), str(p + 1), 'P{}'.format(values['participant_id'][p]),
+                         datetime.date.fromordinal(int(values['enrollment'][p])).isoformat(),
+                         project.choices['grant'][str(values['grant'][p])],
+                         project.choices['protocol'][str(values['protocol'][p])],
+                         RACES[values['race'][p] - 1], ETHNICITIES[values['ethnicity'][p] - 1],
+                         GENDERS[values['gender'][p] - 1]])
+    return rows
+
+
+def test_csv_reads_back(tmp_path, projects, report):
+    counts, batches = report
+    path = str(tmp_path / 'report.csv')
+    expected = expected_rows(projects)
+    assert export_report(path, counts, GRANTS, PROTOCOLS, batches, 'participant_id') == len(expected)
+    with open(path, newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows == [COLUMNS] + expected
+    with open(summary_path(path), newline='') as file:
+        summary = list(csv.reader(file, quotechar='|'))
+    assert summary == [[str(value) for value in row] for row in report_rows(counts, GRANTS, PROTOCOLS)]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather'])
+def test_arrow_reads_back(tmp_path, projects, report, extension):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.feather
+    import pyarrow.parquet
+    read = pyarrow.parquet.read_table if extension == '.parquet' else pyarrow.feather.read_table
+    counts, batches = report
+    path = str(tmp_path / ('report' + extension))
+    export_report(path, counts, GRANTS, PROTOCOLS, batches, 'participant_id')
+
+    table = read(path)
+    assert table.column_names == COLUMNS
+    assert table.schema.field('enrollment').type == pa.date32()
+    assert table.schema.metadata[b'grants'].decode('utf-8').split('\n') == GRANTS
+    rows = [[str(value) for value in row] for row in zip(*(column.to_pylist() for column in table.columns))]
+    assert rows == expected_rows(projects)
+    summary = read(summary_path(path))
+    assert [tuple(row.values()) for row in summary.to_pylist()] == summary_rows(counts)
+
+
+def test_xlsx_sheets(tmp_path, report, monkeypatch):
+    pytest.importorskip('xlsxwriter')
+    monkeypatch.setattr(report_export, 'XLSX_MAX_ROWS', 50)
+    counts, batches = report
+    path = str(tmp_path / 'report.xlsx')
+    written = export_report(path, counts, GRANTS, PROTOCOLS, batches, 'participant_id')
+    with zipfile.ZipFile(path) as workbook:
+        sheets = re.findall(r'<sheet name="([^"]+)"', workbook.read('xl/workbook.xml').decode('utf-8'))
+    # The extract goes on to further sheets of up to 49 participants each, below their header row
+    assert len(sheets) - 1 == -(-written // 49) > 1
+    assert sheets == ['Summary', 'Participants'] + ['Participants {}'.format(i) for i in range(2, len(sheets))]
+
+
+def test_unknown_format(tmp_path, report):
+    counts, batches = report
+    with pytest.raises(ValueError):
+        export_report(str(tmp_path / 'report.txt'), counts, GRANTS, PROTOCOLS, batches)
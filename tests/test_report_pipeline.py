@@ -0,0 +1,90 @@
+import csv
+import datetime
+import io
+
+import numpy as np
+import pytest
+
+import report_pipeline
+from benchmarks.fake_redcap import FakeRedcapServer, SyntheticProject
+from project_metadata import connect
+from report_pipeline import build_filter_logic, csv_lines, export_enrollment_ids, record_payload, stream_records
+
+# Notes spanning lines, with quotes, commas and non-ASCII text, as free text fields are exported
+NOTES = [{'record_id': '1', 'notes': 'first line\nsecond, line'},
+         {'record_id': '2', 'notes': ''},
+         {'record_id': '3', 'notes': 'said "yes"\r\n\nthen\nno'},
+         {'record_id': '4', 'notes': 'Hmong: Nyob zoo, Somali: Soo dhawoow, Amharic: \u1230\u120b\u121d'}]
+
+
+def notes_csv():
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=['record_id', 'notes'], lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(NOTES)
+    return out.getvalue()
+
+
+def test_filter_logic_for_date_range():
+    logic = build_filter_logic(['1', '3'], ['2'], datetime.date(2020, 1, 1), datetime.date(2020, 12, 31))
+    assert logic == ("([grant] = '1' or [grant] = '3') and ([protocol] = '2') and "
+                     "[enrollment] >= '2020-01-01' and [enrollment] < '2021-01-01'")
+
+
+def test_filter_logic_without_date_range():
+    assert build_filter_logic(['1'], ['2', '4'], None, None) == \
+        "([grant] = '1') and ([protocol] = '2' or [protocol] = '4') and [enrollment] <> ''"
+
+
+@pytest.fixture(scope='module')
+def synthetic():
+    return SyntheticProject(1000, seed=3)
+
+
+@pytest.fixture(scope='module')
+def project(synthetic):
+    with FakeRedcapServer(synthetic) as server:
+        yield connect(server.url, 'TOKEN')[0]
+
+
+def test_enrollment_ids_include_the_end_date(synthetic, project):
+    start, end = datetime.date(2016, 1, 1), datetime.date(2016, 6, 30)
+    # Selected enrollments on the first and last day of the range
+    synthetic.values['enrollment'][:2] = [start.toordinal(), end.toordinal()]
+    synthetic.values['grant'][:2] = 1
+    synthetic.values['protocol'][:2] = 3
+    values = synthetic.values
+    expected = np.flatnonzero(np.isin(values['grant'], [1, 2]) & np.isin(values['protocol'], [3, 5, 7]) &
+                              (values['enrollment'] >= start.toordinal()) & (values['enrollment'] <= end.toordinal()))
+    ids = export_enrollment_ids(project, ['1', '2'], ['3', '5', '7'], start, end)
+    assert ids[:2] == ['1', '2']
+    assert ids == [str(position + 1) for position in expected]
+
+
+def test_no_enrollments_without_a_selection(project):
+    assert export_enrollment_ids(project, [], ['1'], None, None) == []
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 1000])
+def test_csv_lines_keeps_quoted_values_whole(size):
+    text = notes_csv()
+    chunks = [text[i:i + size] for i in range(0, len(text), size)]
+    assert list(csv.DictReader(csv_lines(chunks))) == NOTES
+
+
+def test_csv_lines_without_final_newline():
+    assert list(csv_lines(['a,b\n1,', '2'])) == ['a,b\n', '1,2']
+    assert list(csv_lines([])) == []
+
+
+def test_stream_records_with_multi_line_values(monkeypatch, synthetic):
+    monkeypatch.setattr(report_pipeline, 'STREAM_CHUNK_SIZE', 5)
+    with FakeRedcapServer(synthetic) as server:
+        project = connect(server.url, 'TOKEN')[0]
+        respond = server.respond
+        # REDCap sends a byte order mark before csv exports
+        server.respond = lambda params: ('\ufeff' + notes_csv(), 'text/csv') if params.get('content') == 'record' \
+            else respond(params)
+        received = project.bytes_received
+        assert list(stream_records(project, record_payload(project, ['notes']))) == NOTES
+        assert project.bytes_received - received == len(('\ufeff' + notes_csv()).encode('utf-8'))
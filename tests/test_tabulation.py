@@ -0,0 +1,54 @@
+import itertools
+
+import pytest
+
+from tabulation import ETHNICITY_CODES, GENDER_CODES, RACE_CODES, RACES, RaceCheckboxes, cell_codes, demographic_codes
+
+CHOICES = {'1': 'American Indian/Alaska Native', '2': 'Asian', '3': 'Native Hawaiian or Other Pacific Islander',
+           '4': 'Black or African American', '5': 'White', '6': 'More Than One Race', '7': 'Unknown'}
+
+
+def naive_race(labels):
+    races = {label for label in labels if label not in ('More Than One Race', 'Unknown')}
+    if len(races) > 1 or 'More Than One Race' in labels:
+        return RACE_CODES['More Than One Race']
+    if races:
+        return RACE_CODES[races.pop()]
+    return RACE_CODES['Unknown']
+
+
+@pytest.mark.parametrize('mask', range(1 << len(RACES)))
+def test_table_matches_naive_rule(mask):
+    labels = [race for i, race in enumerate(RACES) if mask & (1 << i)]
+    assert RaceCheckboxes(CHOICES).table[mask] == naive_race(labels)
+
+
+def test_raw_checkbox_columns():
+    checkboxes = RaceCheckboxes(CHOICES)
+    participants = []
+    expected = []
+    for ticked in itertools.product('01', repeat=len(CHOICES)):
+        participants.append({'race___{}'.format(code): value for code, value in zip(CHOICES, ticked)})
+        expected.append(naive_race([CHOICES[code] for code, value in zip(CHOICES, ticked) if value == '1']))
+    # A participant whose race columns were not exported counts as Unknown
+    participants.append({})
+    expected.append(RACE_CODES['Unknown'])
+    race, _, _ = demographic_codes(participants, (checkboxes, {}, {}))
+    assert race.tolist() == expected
+
+
+def test_checkbox_codes_and_cells():
+    # REDCap lowercases checkbox codes and replaces '-' in their column names, and other labels count as Unknown
+    checkboxes = RaceCheckboxes({'A': 'Asian', 'W-1': 'White', '99': 'Prefer not to answer'})
+    lookups = (checkboxes, {'1': ETHNICITY_CODES['Hispanic or Latino']}, {'2': GENDER_CODES['Female']})
+    participants = [{'race___a': '1', 'ethnicity': '1', 'gender': '2'},
+                    {'race___a': '1', 'race___w_1': '1', 'ethnicity': '1', 'gender': '2'},
+                    {'race___99': '1', 'ethnicity': '1', 'gender': '2'},
+                    {'race___a': '1', 'ethnicity': '', 'gender': '2'}]
+    race, _, _ = demographic_codes(participants, lookups)
+    assert race.tolist() == [RACE_CODES['Asian'], RACE_CODES['More Than One Race'], RACE_CODES['Unknown'],
+                             RACE_CODES['Asian']]
+    cells = cell_codes(participants, lookups)
+    assert cells[3] == -1
+    assert cells.tolist()[:3] == [(r * 3 + ETHNICITY_CODES['Hispanic or Latino']) * 3 + GENDER_CODES['Female']
+                                  for r in race.tolist()[:3]]
@@ -0,0 +1,79 @@
+"""
+Background worker for running REDCap requests off the GUI thread
+"""
+import threading
+
+import wx
+import wx.lib.newevent
+
+# Posted to the handler when the task finishes, with worker, result and error attributes
+WorkerDoneEvent, EVT_WORKER_DONE = wx.lib.newevent.NewEvent()
+# Posted to the handler as the task reports progress, with worker, message, done and total attributes
+WorkerProgressEvent, EVT_WORKER_PROGRESS = wx.lib.newevent.NewEvent()
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a task when its worker has been cancelled
+    """
+
+
+class Worker(threading.Thread):
+    """
+    Runs a task on a background thread and posts its progress and result back to a window as events.
+
+    The task is called as task(worker, *args) and must not touch any widgets. It reports progress with
+    worker.progress(), which also raises Cancelled once the worker has been cancelled.
+    """
+
+    def __init__(self, handler, task, *args):
+        """
+        :param handler: window to post events to
+        :param task: function to run
+        :param args: arguments passed to the task after the worker
+        """
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.task = task
+        self.args = args
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            result = self.task(self, *self.args)
+        except Cancelled:
+            return
+        except Exception as e:
+            self.post(WorkerDoneEvent(worker=self, result=None, error=e))
+        else:
+            self.post(WorkerDoneEvent(worker=self, result=result, error=None))
+
+    def post(self, event):
+        """
+        Deliver an event to the handler on the GUI thread
+        :param event: event to deliver
+        """
+        wx.CallAfter(self._deliver, event)
+
+    def _deliver(self, event):
+        # The window may have been destroyed while the task was running
+        if self.handler and not self.cancelled.is_set():
+            self.handler.GetEventHandler().ProcessEvent(event)
+
+    def progress(self, message, done=0, total=0):
+        """
+        Report progress of the task
+        :param message: description of the current step
+        :param done: units of work done
+        :param total: total units of work, 0 if unknown
+        :raises Cancelled: if the worker has been cancelled
+        """
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.post(WorkerProgressEvent(worker=self, message=message, done=done, total=total))
+
+    def cancel(self):
+        """
+        Ask the task to stop at its next progress report and drop any events it still posts
+        """
+        self.cancelled.set()